@@ -0,0 +1,298 @@
+"""
+Benchmark suite for trial generation, validation and block I/O
+
+For each point of a grid of (num_trials, marginal_tolerance, prob_cp) values, records the wall time and the number of
+attempts per accepted block, the acceptance rate, the peak memory of a generation, the time of the validation
+functions and the write and read times of a block in each of trial_gen.DATA_FORMATS. Runs offline, with the standard
+library and the dependencies of trial_gen only.
+
+The cold start of the metadata-only commands of cli.py (verify and inspect) is measured too, in fresh interpreters as
+when they are called from shell scripts. These commands should stay within COLD_START_BUDGET and never import
+HEAVY_MODULES, whatever the baseline.
+
+Baselines are machine-specific: save one on the machine used for comparisons, then compare later runs against it.
+
+Example usage:
+  $ python bench_trial_gen.py --save-baseline bench_baseline.json
+  $ python bench_trial_gen.py --compare bench_baseline.json  # exit code 1 if a regression is flagged
+  $ python bench_trial_gen.py --quick --output results.json
+  $ python bench_trial_gen.py --quick --reps 1 --skip-cold-start
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from trial_gen import DATA_FORMATS, GENERATOR_VERSION, Trials, get_marginals
+
+FULL_GRID = {'num_trials': [204, 250], 'marginal_tolerance': [0.05, 0.02, 0.01], 'prob_cp': [0, 0.2, 0.5, 0.8]}
+QUICK_GRID = {'num_trials': [250], 'marginal_tolerance': [0.05, 0.02], 'prob_cp': [0, 0.8]}
+
+# metrics compared against baselines, all of them are "lower is better"
+COMPARED_METRICS = ['time_per_block', 'mean_attempts', 'peak_memory', 'check_conditions_time', 'get_marginals_time',
+                    'check_candidates_time'] + [f'{fmt}_{op}_time' for fmt in DATA_FORMATS for op in ['write', 'read']]
+MIN_TIME_DIFFERENCE = 2e-3  # in seconds, smaller slowdowns are considered noise
+NOISE_SPREADS = 3  # slowdowns within this many spreads of the repeated timings are considered noise too
+COLD_START_COMMANDS = ('verify', 'inspect')
+COLD_START_BUDGET = 0.25  # in seconds, median wall time of a command, interpreter startup included
+HEAVY_MODULES = ('numpy', 'pandas')
+
+
+def spread(times):
+    """
+    :param times: (list of float) repeated timings
+    :return: (float) median absolute deviation of the timings
+    """
+    return float(np.median(np.abs(np.asarray(times) - np.median(times))))
+
+
+def time_call(func, repeat):
+    """
+    :param func: callable without arguments
+    :param repeat: (int) number of calls
+    :return: tuple (median, spread) of the wall time of a call, in seconds, see spread()
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), spread(times)
+
+
+def record_time(metrics, name, func, repeat, scale=1):
+    """
+    times func with time_call() and stores the median as metrics[name] and the spread as metrics[name + '_spread']
+    :param scale: (float) factor applied to both values, e.g. to get the time per item of a batch
+    """
+    median, time_spread = time_call(func, repeat)
+    metrics[name] = median * scale
+    metrics[name + '_spread'] = time_spread * scale
+
+
+def bench_case(num_trials, marginal_tolerance, prob_cp, reps, max_attempts):
+    """
+    runs all benchmarks for one point of the grid
+    :return: (dict) metrics of the case
+    """
+    kwargs = dict(prob_cp=prob_cp, num_trials=num_trials, marginal_tolerance=marginal_tolerance,
+                  max_attempts=max_attempts)
+
+    gen_times, attempts, blocks = [], [], []
+    for rep in range(reps):
+        start = time.perf_counter()
+        trials = Trials(seed=rep + 1, **kwargs)
+        gen_times.append(time.perf_counter() - start)
+        attempts.append(trials.attempt_number)
+        if trials.trial_data is not None:
+            blocks.append(trials)
+
+    # memory is measured in a separate run, since tracing slows allocations down
+    tracemalloc.start()
+    Trials(seed=1, **kwargs)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    case = {
+        'num_trials': num_trials,
+        'marginal_tolerance': marginal_tolerance,
+        'prob_cp': prob_cp,
+        'accepted_blocks': len(blocks),
+        'time_per_block': sum(gen_times) / max(len(blocks), 1),
+        'time_per_block_spread': spread(gen_times) * len(gen_times) / max(len(blocks), 1),
+        'mean_attempts': float(np.mean(attempts)),
+        'acceptance_rate': len(blocks) / sum(attempts),
+        'peak_memory': peak_memory
+    }
+
+    if not blocks:
+        return case
+
+    trials = blocks[0]
+    df = trials.trial_data
+    codes, cp_flags = trials.draw_candidates(1000, num_trials)
+    record_time(case, 'check_conditions_time', lambda: trials.check_conditions(df, append_marginals=False), 20)
+    record_time(case, 'get_marginals_time', lambda: get_marginals(df), 20)
+    record_time(case, 'check_candidates_time', lambda: trials.check_candidates(codes, cp_flags), 5, scale=1 / 1000)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fmt in DATA_FORMATS:
+            filename = os.path.join(tmp_dir, 'block.' + fmt)
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull  # save and load methods print progress messages
+                try:
+                    record_time(case, f'{fmt}_write_time', lambda: trials.save_to_csv(filename), 10)
+                    record_time(case, f'{fmt}_read_time', lambda: Trials(from_file=filename).trial_data, 10)
+                finally:
+                    sys.stdout = stdout
+    return case
+
+
+def bench_cold_start(reps):
+    """
+    runs the metadata-only commands of cli.py on a block file, each in a fresh interpreter
+    :param reps: (int) number of runs of each command
+    :return: (dict) median wall time of a bare interpreter start and of each command, and the HEAVY_MODULES imported
+             by each command
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_dir, os.environ.get('PYTHONPATH')])))
+
+    def run(args):
+        return subprocess.run([sys.executable] + args, env=env, check=True, capture_output=True, text=True).stdout
+
+    results = {}
+    record_time(results, 'interpreter_time', lambda: run(['-c', 'pass']), reps)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'block.csv')
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                Trials(seed=1).save_to_csv(filename)
+            finally:
+                sys.stdout = stdout
+
+        for command in COLD_START_COMMANDS:
+            argv = [command, filename]
+            record_time(results, f'{command}_time', lambda: run([os.path.join(package_dir, 'cli.py')] + argv), reps)
+            # imports are listed in a separate run, after the command
+            probe = (f'import sys, cli; cli.main({argv!r}); '
+                     f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+            heavy = run(['-c', probe]).splitlines()[-1]
+            results[f'{command}_heavy_imports'] = heavy.split(',') if heavy else []
+    return results
+
+
+def cold_start_violations(cold_start):
+    """
+    :param cold_start: (dict) as returned by bench_cold_start()
+    :return: list of messages, one per command over COLD_START_BUDGET or importing HEAVY_MODULES
+    """
+    violations = []
+    for command in COLD_START_COMMANDS:
+        if cold_start[f'{command}_time'] > COLD_START_BUDGET:
+            violations.append(f"{command} took {cold_start[f'{command}_time']:.3f} s, "
+                              f"over the budget of {COLD_START_BUDGET} s")
+        if cold_start[f'{command}_heavy_imports']:
+            violations.append(f"{command} imported {', '.join(cold_start[f'{command}_heavy_imports'])}")
+    return violations
+
+
+def run_benchmarks(grid, reps, max_attempts, cold_start=True):
+    cases = []
+    for num_trials in grid['num_trials']:
+        for marginal_tolerance in grid['marginal_tolerance']:
+            for prob_cp in grid['prob_cp']:
+                case = bench_case(num_trials, marginal_tolerance, prob_cp, reps, max_attempts)
+                print(f"num_trials={num_trials:<5} tol={marginal_tolerance:<6} prob_cp={prob_cp:<5}"
+                      f"{case['time_per_block'] * 1000:>10.2f} ms/block{case['mean_attempts']:>10.1f} attempts")
+                cases.append(case)
+
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'generator_version': GENERATOR_VERSION,
+            'reps': reps,
+            'max_attempts': max_attempts
+        },
+        'cases': cases
+    }
+    if cold_start:
+        results['cold_start'] = bench_cold_start(max(reps, 5))
+        print('cold start: ' + ' '.join(f"{c} {results['cold_start'][f'{c}_time'] * 1000:.1f} ms"
+                                        for c in COLD_START_COMMANDS) +
+              f" (bare interpreter {results['cold_start']['interpreter_time'] * 1000:.1f} ms)")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    flags metrics which got worse than in the baseline by more than the relative threshold. Slowdowns smaller than
+    MIN_TIME_DIFFERENCE, or than NOISE_SPREADS times the spread of the timings in either run, are ignored
+    :param results: (dict) as returned by run_benchmarks()
+    :param baseline: (dict) as returned by run_benchmarks()
+    :param threshold: (float) relative tolerance, e.g. 0.25 for 25%
+    :return: list of (case key, metric, baseline value, new value) tuples, one per regression
+    """
+    def case_key(c):
+        return c['num_trials'], c['marginal_tolerance'], c['prob_cp']
+
+    def is_noise(metric, new_metrics, old_metrics):
+        # baselines saved before spreads were recorded only get the fixed floor
+        noise = NOISE_SPREADS * max(new_metrics.get(metric + '_spread', 0), old_metrics.get(metric + '_spread', 0))
+        return new_metrics[metric] - old_metrics[metric] < max(MIN_TIME_DIFFERENCE, noise)
+
+    baseline_cases = {case_key(c): c for c in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        base = baseline_cases.get(case_key(case))
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in case or metric not in base:
+                continue
+            new, old = case[metric], base[metric]
+            if metric[-4:] == 'time' and is_noise(metric, case, base):
+                continue
+            if new > old * (1 + threshold):
+                regressions.append((case_key(case), metric, old, new))
+
+    if 'cold_start' in results and 'cold_start' in baseline:
+        for command in COLD_START_COMMANDS:
+            metric = f'{command}_time'
+            new, old = results['cold_start'][metric], baseline['cold_start'][metric]
+            if not is_noise(metric, results['cold_start'], baseline['cold_start']) and new > old * (1 + threshold):
+                regressions.append(('cold_start', metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks of trial generation, validation and block I/O')
+    parser.add_argument('--quick', action='store_true', help='run on a reduced grid')
+    parser.add_argument('--reps', type=int, default=5, help='number of blocks generated per grid point')
+    parser.add_argument('--max-attempts', type=int, default=10000)
+    parser.add_argument('--output', default=None, help='json file where results are written')
+    parser.add_argument('--save-baseline', default=None, help='json file where results are written as baseline')
+    parser.add_argument('--compare', default=None, help='baseline json file to compare results against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown flagged as a regression')
+    parser.add_argument('--skip-cold-start', action='store_true', help='do not measure the cold start of cli.py')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(QUICK_GRID if args.quick else FULL_GRID, args.reps, args.max_attempts,
+                             cold_start=not args.skip_cold_start)
+
+    for filename in [args.output, args.save_baseline]:
+        if filename is not None:
+            with open(filename, 'w') as fp:
+                json.dump(results, fp, indent=4)
+
+    violations = cold_start_violations(results['cold_start']) if 'cold_start' in results else []
+    for message in violations:
+        print(f'COLD START {message}')
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        for key, metric, old, new in regressions:
+            print(f'REGRESSION {key} {metric}: {old:.6g} -> {new:.6g}')
+        print(f'{len(regressions)} regressions against {args.compare}')
+        return 1 if regressions or violations else 0
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
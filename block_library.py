@@ -0,0 +1,393 @@
+"""
+This module builds whole libraries of blocks of trials (e.g. the content of a Blocks003/ folder) in parallel, and
+indexes existing libraries for fast queries
+
+Example usage:
+  >>>> schedule = read_block_schedule('DefaultBlockSequence.csv')
+  >>>> jobs = library_jobs(schedule, prob_cp_seq=[0.2, 0.5, 0.8] * 3, root_seed=3, out_dir='Blocks004')
+  >>>> reports = build_library(jobs)  # one dict per block, with timing and attempt counts
+  >>>> reports = build_block_set(jobs, prefix=200)  # or all blocks together, with balanced pooled counts
+  >>>> library = BlockLibrary('Blocks004')  # creates or refreshes Blocks004/block_manifest.json
+  >>>> library.count_conditions(['coh', 'cp', 'vd'], prob_cp=0.8, num_trials=200)
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from trial_files import block_filenames, data_format, md5
+from trial_gen import ALLOWED_PROB_CP, MARGINALS_TEMPLATE, TENSOR_AXES, TENSOR_SHAPE, Trials, allocate_blocks, \
+    block_seed_kwargs, cell_codes, codes_to_tensor, sample_prob_cp_seq, standard_meta_filename, tensor_to_counts, \
+    write_atomically
+from trial_cache import TrialCache
+from seed_registry import SEED_KWARGS, parameter_key, pick_seeds
+
+MANIFEST_FILENAME = 'block_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def read_block_schedule(filename):
+    """
+    reads a block schedule such as DefaultBlockSequence.csv, i.e. a csv file without header and with one line per
+    block of the form name,num_trials
+    :param filename: (str) path to schedule file
+    :return: list of (name, num_trials) tuples, in file order
+    """
+    with open(filename, 'r', newline='') as fp:
+        return [(row[0].strip(), int(row[1])) for row in csv.reader(fp) if row]
+
+
+def default_prob_cp_seq(num_blocks, seed_seq):
+    """
+    draws a prob_cp sequence where every non-zero value of ALLOWED_PROB_CP is used equally often, without two
+    consecutive blocks sharing the same value
+    :param num_blocks: (int) number of dual-report blocks, should be a multiple of the number of values
+    :param seed_seq: numpy.random.SeedSequence
+    :return: list of prob_cp values
+    """
+    all_vals = sorted(ALLOWED_PROB_CP - {0})
+    assert num_blocks % len(all_vals) == 0, f'number of blocks should be a multiple of {len(all_vals)}'
+    quotas = {v: num_blocks // len(all_vals) for v in all_vals}
+    return sample_prob_cp_seq(quotas, np.random.default_rng(seed_seq))
+
+
+def library_jobs(schedule, prob_cp_seq, root_seed, out_dir, marginal_tolerance=0.01, num_trials=None,
+                 method='rejection', max_attempts=10000, cache_dir=None, cache_max_bytes=None, seed_registry=None,
+                 processes=None):
+    """
+    turns a block schedule into the list of blocks to generate. Tutorials and Quest entries are skipped, Block2 is the
+    standard dots task (prob_cp=0), and the other blocks are dual-report blocks which receive the values of
+    prob_cp_seq in order. Seeds of all blocks derive from root_seed, see trial_gen.block_seed_kwargs(); the spawn key
+    of a block is its position in the schedule, and the spawn key (len(schedule),) is used to draw prob_cp_seq
+    when it is not provided
+    :param schedule: list of (name, num_trials) tuples, as returned by read_block_schedule()
+    :param prob_cp_seq: (list or None) prob_cp values for the dual-report blocks. If None, a sequence is drawn with
+                        trial_gen.sample_prob_cp_seq(), with every non-zero value of ALLOWED_PROB_CP used equally often
+    :param root_seed: (int) root seed of the library
+    :param out_dir: (str) directory where the csv and metadata files are written
+    :param marginal_tolerance: passed to Trials()
+    :param num_trials: (int or None) number of trials per block. If None, the number from the schedule is used
+    :param method: passed to Trials()
+    :param max_attempts: passed to Trials()
+    :param cache_dir: (str or None) if provided, blocks are fetched from or stored into a trial_cache.TrialCache
+                      in this directory
+    :param cache_max_bytes: (int or None) size limit of the cache
+    :param seed_registry: (seed_registry.SeedRegistry or None) if provided, blocks use distinct known-good seeds from
+                          the registry (with an empty spawn key) instead of seeds derived from root_seed, so that
+                          each block is generated without a failed seed. Missing good seeds are searched first
+    :param processes: (int or None) number of worker processes of the seed search, see seed_registry.pick_seeds()
+    :return: list of dicts, one per block to generate, to be passed to build_library()
+    """
+    seed_kwargs = block_seed_kwargs(root_seed, len(schedule))
+    dual_report_names = [name for name, _ in schedule if name[:5] == 'Block' and name != 'Block2']
+    if prob_cp_seq is None:
+        prob_cp_seq = default_prob_cp_seq(len(dual_report_names),
+                                          np.random.SeedSequence(root_seed, spawn_key=(len(schedule),)))
+    assert len(prob_cp_seq) == len(dual_report_names), \
+        f'{len(dual_report_names)} prob_cp values are needed, {len(prob_cp_seq)} were provided'
+
+    jobs = []
+    dual_report_block_count = 0
+    for position, (name, schedule_num_trials) in enumerate(schedule):
+        # todo: deal with tutorials
+        if name[:5] != 'Block':
+            continue
+
+        if name == 'Block2':  # Block2 is the standard dots task
+            prob_cp = 0
+        else:
+            prob_cp = prob_cp_seq[dual_report_block_count]
+            dual_report_block_count += 1
+
+        jobs.append({
+            'filename': os.path.join(out_dir, name + '.csv'),
+            'trials_kwargs': dict(prob_cp=prob_cp,
+                                  num_trials=schedule_num_trials if num_trials is None else num_trials,
+                                  marginal_tolerance=marginal_tolerance,
+                                  method=method,
+                                  max_attempts=max_attempts,
+                                  **seed_kwargs[position]),
+            'cache_dir': cache_dir,
+            'cache_max_bytes': cache_max_bytes
+        })
+
+    if seed_registry is not None:
+        # blocks which share their parameters get distinct seeds, in order of the schedule
+        groups = {}
+        for job in jobs:
+            params = {k: v for k, v in job['trials_kwargs'].items() if k not in SEED_KWARGS}
+            groups.setdefault(parameter_key(params), (params, []))[1].append(job)
+        used_seeds = set()  # all blocks of the library get distinct seeds
+        for params, group_jobs in groups.values():
+            seeds = pick_seeds(params, len(group_jobs), seed_registry, processes=processes, exclude=used_seeds)
+            used_seeds.update(seeds)
+            for job, seed in zip(group_jobs, seeds):
+                job['trials_kwargs'].update(seed=seed, spawn_key=())
+    return jobs
+
+
+def build_block(job):
+    """
+    generates and saves a single block. Module-level function so that it can be sent to worker processes
+    :param job: (dict) one entry of the list returned by library_jobs()
+    :return: (dict) report with the generation outcome, attempt count and timings in seconds
+    """
+    start = time.perf_counter()
+    cache_hit = False
+    if job.get('cache_dir') is None:
+        trials = Trials(**job['trials_kwargs'])
+    else:
+        cache = TrialCache(job['cache_dir'], max_bytes=job.get('cache_max_bytes'))
+        trials = cache.get(**job['trials_kwargs'])
+        cache_hit = cache.stats['hits'] == 1
+    generated = time.perf_counter()
+
+    success = trials.trial_data is not None
+    if success:
+        trials.save_to_csv(job['filename'])
+    written = time.perf_counter()
+
+    return {
+        'filename': job['filename'],
+        'prob_cp': trials.prob_cp,
+        'seed': trials.seed,
+        'spawn_key': list(trials.spawn_key),
+        'success': success,
+        'attempt_number': trials.attempt_number,
+        'cache_hit': cache_hit,
+        'generation_time': generated - start,
+        'write_time': written - generated
+    }
+
+
+def build_library(jobs, processes=None):
+    """
+    generates all blocks of a library, spread over a pool of processes. Output is deterministic for a given list of
+    jobs, whatever the number of processes, since every block carries its own seed
+    :param jobs: list of dicts as returned by library_jobs()
+    :param processes: (int or None) number of worker processes. None uses all cores, 1 runs in the current process
+    :return: list of reports as returned by build_block(), in the order of jobs
+    """
+    for job in jobs:
+        os.makedirs(os.path.dirname(job['filename']) or '.', exist_ok=True)
+
+    if processes == 1:
+        return [build_block(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(build_block, jobs))
+
+
+def build_block_set(jobs, prefix=None):
+    """
+    generates all blocks of a library together, so that the counts pooled over the blocks which share a prob_cp value
+    hit target cell counts, while each block meets its own conditions. For each prob_cp value, the target counts of
+    the pooled trials are given by Trials.quota_counts() and split between the blocks with
+    trial_gen.allocate_blocks(), then each block shuffles its own trials with its own seed. There is a single pass,
+    without retries. When prefix is provided, the first prefix trials of the blocks and the remaining trials are
+    allocated separately, so that the pooled counts of truncated blocks (as in trial_counts.py) hit their targets too.
+    The cache options of the jobs are ignored, and the blocks are saved with method 'block_set': since they depend on
+    each other, a single block cannot be regenerated from its own seed
+    :param jobs: list of dicts as returned by library_jobs(). Their method and max_attempts are ignored
+    :param prefix: (int or None) number of trials, from the start of each block, balanced on their own
+    :return: list of reports as returned by build_block(), in the order of jobs
+    """
+    start = time.perf_counter()
+    blocks = []
+    for job in jobs:
+        os.makedirs(os.path.dirname(job['filename']) or '.', exist_ok=True)
+        trials = Trials(**dict(job['trials_kwargs'], generate=False))
+        num_trials = job['trials_kwargs']['num_trials']
+        segments = [num_trials] if prefix is None else [min(prefix, num_trials), max(num_trials - prefix, 0)]
+        blocks.append((trials, segments, []))
+
+    for prob_cp in sorted({trials.prob_cp for trials, _, _ in blocks}):
+        group = [b for b in blocks if b[0].prob_cp == prob_cp]
+        template = group[0][0]
+        for trials, _, _ in group:
+            assert trials.theoretical_marginals == template.theoretical_marginals, \
+                'blocks with the same prob_cp value should share their marginals'
+
+        for segment in range(len(group[0][1])):
+            sizes = [segments[segment] for _, segments, _ in group]
+            comb_codes, cp_flags, pooled_counts = template.quota_counts(sum(sizes))
+            table = allocate_blocks(pooled_counts, template.cell_levels(comb_codes, cp_flags),
+                                    template.marginal_probs(), sizes)
+            for (trials, _, parts), counts in zip(group, table):
+                parts.append(trials.counts_to_trials(comb_codes, cp_flags, counts))
+    generated = time.perf_counter()
+
+    reports = []
+    for job, (trials, segments, parts) in zip(jobs, blocks):
+        write_start = time.perf_counter()
+        trial_df = pd.concat(parts, ignore_index=True)
+        trial_df.coh = trial_df.coh.astype('category')
+        trials.method = 'block_set'
+        trials.checkpoints = None if len(segments) == 1 else segments[:1]
+        trials.attempt_number = 1
+        success = trials.check_conditions(trial_df)
+        if success and trials.checkpoints:
+            success = bool(trials.checkpoint_checks(trial_df, trials.checkpoints).all())
+        if success:
+            trials.trial_data = trial_df
+            trials.num_trials = len(trial_df)
+            trials.save_to_csv(job['filename'])
+        else:
+            print(f"block {job['filename']} does not meet the conditions, it was not written")
+
+        reports.append({
+            'filename': job['filename'],
+            'prob_cp': trials.prob_cp,
+            'seed': trials.seed,
+            'spawn_key': list(trials.spawn_key),
+            'success': success,
+            'attempt_number': trials.attempt_number,
+            'cache_hit': False,
+            'generation_time': (generated - start) / len(jobs),  # the allocation is shared by all blocks
+            'write_time': time.perf_counter() - write_start
+        })
+    return reports
+
+
+def _file_signature(filename):
+    """
+    cheap fingerprint of a file, used to detect changes without reading it
+    :param filename: (str)
+    :return: (list) [mtime in ns, size in bytes]
+    """
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class BlockLibrary:
+    """
+    index over a directory of block files (csv or npy files with their metadata files, as written by
+    Trials.save_to_csv())
+
+    The index is stored in the directory as a manifest file (MANIFEST_FILENAME). Each entry, keyed by data filename,
+    holds the main metadata (prob_cp, seed, num_trials, csv_md5), the cell code of every trial (see
+    trial_gen.cell_codes()), from which count tensors of any prefix of the block are derived, and the mtime and size of
+    both files. Refreshing the index only re-reads the files whose mtime or size changed, and queries are answered from
+    the index without re-hashing or re-parsing the block files.
+    """
+    def __init__(self, directory, refresh=True):
+        """
+        :param directory: (str) directory containing the block files
+        :param refresh: (bool) whether to bring the manifest up to date with the directory right away
+        """
+        self.directory = directory
+        self.manifest_filename = os.path.join(directory, MANIFEST_FILENAME)
+        self.entries = {}
+
+        if os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, 'r') as fp:
+                manifest = json.load(fp)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.entries = manifest['blocks']
+
+        if refresh:
+            self.refresh()
+
+    def block_filenames(self):
+        """
+        data files of the directory (in any of trial_gen.DATA_FORMATS) which have a metadata file
+        :return: sorted list of file names, relative to self.directory
+        """
+        return block_filenames(self.directory)
+
+    def _index_block(self, filename, signature):
+        """
+        reads a single block (verifying its MD5) and builds its manifest entry. The codes of npy blocks are read from
+        the memory-mapped file
+        :param filename: (str) file name relative to self.directory
+        :param signature: (dict) file signatures of the csv and metadata files
+        :return: (dict) manifest entry
+        """
+        full_name = os.path.join(self.directory, filename)
+        if data_format(full_name) == 'npy':
+            # the mapped codes are used as they are, without decoding them into a data frame
+            trials = Trials(from_file=full_name, lazy=True)
+            assert md5(full_name) == trials.csv_md5, f'MD5 check failed for {filename}!'
+            assert trials.label_codes == {k: list(MARGINALS_TEMPLATE[k]) for k in TENSOR_AXES}, \
+                f'unexpected label codes in the metadata of {filename}'
+            codes = np.ravel_multi_index(trials.get_trial_codes().astype(int), TENSOR_SHAPE)
+        else:
+            trials = Trials(from_file=full_name)
+            codes = cell_codes(trials.trial_data)
+        return {
+            'prob_cp': trials.prob_cp,
+            'seed': trials.seed,
+            'spawn_key': trials.spawn_key,
+            'num_trials': trials.num_trials,
+            'csv_md5': trials.csv_md5,
+            'cell_codes': codes.tolist(),
+            'signature': signature
+        }
+
+    def refresh(self):
+        """
+        brings the index up to date with the directory: new or modified blocks are (re-)indexed, deleted blocks are
+        dropped, and unchanged blocks are left untouched. The manifest file is rewritten only if something changed
+        :return: (int) number of blocks that were (re-)indexed
+        """
+        filenames = self.block_filenames()
+        removed = set(self.entries) - set(filenames)
+        for f in removed:
+            del self.entries[f]
+
+        num_indexed = 0
+        for f in filenames:
+            full_name = os.path.join(self.directory, f)
+            signature = {'csv': _file_signature(full_name),
+                         'metadata': _file_signature(standard_meta_filename(full_name))}
+            if f in self.entries and self.entries[f]['signature'] == signature:
+                continue
+            self.entries[f] = self._index_block(f, signature)
+            num_indexed += 1
+
+        if num_indexed or removed or not os.path.exists(self.manifest_filename):
+            self.save_manifest()
+        return num_indexed
+
+    def save_manifest(self):
+        manifest = {'version': MANIFEST_VERSION, 'blocks': self.entries}
+        write_atomically(self.manifest_filename, json.dumps(manifest).encode())
+
+    def select(self, prob_cp=None):
+        """
+        :param prob_cp: (float or None) if provided, only blocks with this prob_cp value are selected
+        :return: sorted list of file names (relative to self.directory) of the selected blocks
+        """
+        return sorted(f for f, entry in self.entries.items() if prob_cp is None or entry['prob_cp'] == prob_cp)
+
+    def count_tensor(self, prob_cp=None, num_trials=None):
+        """
+        count tensor pooled over the selected blocks, computed from the index only
+        :param prob_cp: see self.select()
+        :param num_trials: (int or None) if provided, only the first num_trials trials of each block are counted
+        :return: (numpy.ndarray of int) tensor with shape trial_gen.TENSOR_SHAPE
+        """
+        tensor = np.zeros(TENSOR_SHAPE, dtype=int)
+        for f in self.select(prob_cp):
+            tensor += codes_to_tensor(np.array(self.entries[f]['cell_codes'][:num_trials], dtype=int))
+        return tensor
+
+    def count_conditions(self, ind_vars, prob_cp=None, num_trials=None):
+        """
+        number of trials for each combination of values of the given independent variables, pooled over the selected
+        blocks, see self.count_tensor() and trial_gen.tensor_to_counts()
+        :return: pandas.DataFrame with one column per independent variable plus a 'count' column
+        """
+        return tensor_to_counts(self.count_tensor(prob_cp, num_trials), ind_vars)
+
+    def load(self, filename, **kwargs):
+        """
+        :param filename: (str) file name relative to self.directory
+        :param kwargs: loading options passed to Trials(), e.g. lazy, nrows, usecols or verify_md5
+        :return: Trials object loaded from the block file
+        """
+        return Trials(from_file=os.path.join(self.directory, filename), **kwargs)
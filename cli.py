@@ -0,0 +1,344 @@
+"""
+Command line entry point for the trial generation tools
+
+numpy and pandas are only imported by the subcommands which need them, so that metadata-only subcommands such as
+verify and inspect start fast when called from shell scripts (see the cold start budget in bench_trial_gen.py).
+
+Example usage:
+  $ python cli.py generate Blocks003/Block3.csv --prob-cp 0.8 --num-trials 250 --seed 3 --marginal-tolerance 0.01
+  $ python cli.py verify Blocks003
+  $ python cli.py inspect Blocks003/Block3.csv
+  $ python cli.py count Blocks003 --num-trials 200 --output Blocks003/trial_comb_count.csv  # as trial_counts.py
+  $ python cli.py build-library Blocks004 --prob-cp 0.2 0.5 0.8 0.5 0.8 0.2 0.8 0.2 0.5 --root-seed 3
+  $ python cli.py build-library Blocks005 --root-seed 4  # prob_cp sequence drawn from the root seed
+  $ python cli.py build-library Blocks006 --root-seed 5 --joint --prefix 200  # pooled counts balanced as well
+  $ python cli.py search-seeds seed_registry.json --prob-cp 0.8 --num-trials 204 --num-wanted 10
+  $ python cli.py build-library Blocks007 --seed-registry seed_registry.json  # known-good seeds only
+  $ python cli.py pack Blocks003 Blocks003.trials  # whole library in a single file
+  $ python cli.py export Blocks003.trials Blocks003 --csv  # loose csv files, as read by the MATLAB task
+  $ python cli.py quest-fits SingleCP_DotsReversal/raw  # latest Quest fit per subject
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def data_files(paths):
+    """
+    :param paths: (list of str) data files, metadata files, archives or library directories
+    :return: (list of str) the given files, with directories replaced by the data files of their blocks
+    """
+    from trial_files import block_filenames
+
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += [os.path.join(path, f) for f in block_filenames(path)]
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def generate_command(args):
+    from trial_gen import Trials
+
+    trials = Trials(prob_cp=args.prob_cp, num_trials=args.num_trials, seed=args.seed, spawn_key=tuple(args.spawn_key),
+                    marginal_tolerance=args.marginal_tolerance, method=args.method, max_attempts=args.max_attempts,
+                    checkpoints=args.checkpoints, preflight=args.preflight)
+    if trials.trial_data is None:
+        return 1
+    trials.save_to_csv(args.filename)
+    print(f'{trials.num_trials} trials generated with method {trials.method} in {trials.attempt_number} attempts')
+    return 0
+
+
+def verify_command(args):
+    from library_archive import LibraryArchive, is_archive
+    from trial_files import load_meta_data, md5
+
+    num_checked, num_failed = 0, 0
+    for f in data_files(args.paths):
+        if os.path.isfile(f) and is_archive(f):
+            archive = LibraryArchive(f)
+            checks = []
+            for name in archive.names():
+                try:
+                    archive.read(name)
+                    checks.append((f'{f}:{name}', True))
+                except AssertionError:
+                    checks.append((f'{f}:{name}', False))
+        else:
+            try:
+                checks = [(f, load_meta_data(f)['csv_md5'] == md5(f))]
+            except (OSError, ValueError, KeyError):
+                checks = [(f, False)]
+
+        for name, ok in checks:
+            if not ok or not args.quiet:
+                print(f"{'OK' if ok else 'FAILED':<8}{name}")
+            num_checked += 1
+            num_failed += not ok
+    print(f'{num_checked - num_failed} of {num_checked} files verified')
+    return 1 if num_failed else 0
+
+
+def inspect_command(args):
+    from library_archive import LibraryArchive, is_archive
+    from trial_files import load_meta_data
+
+    entries = []
+    for f in data_files(args.paths):
+        if os.path.isfile(f) and is_archive(f):
+            archive = LibraryArchive(f)
+            entries += [(f'{f}:{name}', archive.meta_data(name)) for name in archive.block_names()]
+        else:
+            entries.append((f, load_meta_data(f)))
+
+    if args.json:
+        print(json.dumps(dict(entries), indent=4))
+        return 0
+
+    print(f"{'file':<40}{'prob_cp':>8}{'trials':>8}{'seed':>8}{'spawn_key':>10}{'method':>11}{'tol':>7}"
+          f"{'attempts':>10}{'format':>8}")
+    for name, meta in entries:
+        print(f"{name:<40}{meta['prob_cp']:>8}{meta['num_trials']:>8}{meta['seed']:>8}"
+              f"{str(meta.get('spawn_key', '')):>10}{meta.get('method', 'rejection'):>11}"
+              f"{meta['marginal_tolerance']:>7}{str(meta.get('attempt_number', '')):>10}"
+              f"{meta.get('data_format', 'csv'):>8}")
+    return 0
+
+
+def count_command(args):
+    import pandas as pd
+    from block_library import BlockLibrary
+    from trial_files import write_atomically
+
+    library = BlockLibrary(args.directory)
+    prob_cps = sorted({e['prob_cp'] for e in library.entries.values()}) if args.prob_cp is None else [args.prob_cp]
+    if not prob_cps:
+        print(f'no blocks found in {args.directory}')
+        return 1
+
+    counts = []
+    for prob_cp in prob_cps:
+        df = library.count_conditions(args.ind_vars, prob_cp=prob_cp, num_trials=args.num_trials)
+        if not args.keep_zeros:
+            df = df[df['count'] > 0].copy()
+        df['prob_cp'] = prob_cp
+        counts.append(df)
+    counts = pd.concat(counts)
+
+    if args.output is None:
+        print(counts.to_string(index=False))
+    else:
+        write_atomically(args.output, counts.to_csv(index=False).encode())
+        print(f'file {args.output} created')
+    return 0
+
+
+def build_library_command(args):
+    from block_library import read_block_schedule, library_jobs, build_library, build_block_set
+    from seed_registry import SeedRegistry
+    from trial_files import atomic_path
+
+    schedule = read_block_schedule(args.schedule)
+    jobs = library_jobs(schedule, args.prob_cp, args.root_seed, args.out_dir,
+                        marginal_tolerance=args.marginal_tolerance,
+                        num_trials=args.num_trials,
+                        method=args.method,
+                        max_attempts=args.max_attempts,
+                        cache_dir=args.cache_dir,
+                        cache_max_bytes=None if args.cache_max_mb is None else int(args.cache_max_mb * 2 ** 20),
+                        seed_registry=None if args.seed_registry is None else SeedRegistry(args.seed_registry),
+                        processes=args.processes)
+
+    start = time.perf_counter()
+    if args.joint:
+        reports = build_block_set(jobs, prefix=args.prefix)
+    else:
+        reports = build_library(jobs, processes=args.processes)
+    total_time = time.perf_counter() - start
+
+    print(f"{'file':<30}{'prob_cp':>8}{'attempts':>10}{'gen (s)':>10}{'write (s)':>10}")
+    for r in reports:
+        status = ('' if r['success'] else '  FAILED') + ('  (cached)' if r['cache_hit'] else '')
+        print(f"{os.path.basename(r['filename']):<30}{r['prob_cp']:>8}{r['attempt_number']:>10}"
+              f"{r['generation_time']:>10.3f}{r['write_time']:>10.3f}{status}")
+    print(f'{len(reports)} blocks built in {total_time:.3f} s')
+    if args.cache_dir is not None:
+        num_hits = sum(r['cache_hit'] for r in reports)
+        print(f'cache: {num_hits} hits, {len(reports) - num_hits} misses')
+
+    with atomic_path(os.path.join(args.out_dir, 'build_report.json')) as tmp_filename:
+        with open(tmp_filename, 'w') as fp:
+            json.dump({'root_seed': args.root_seed, 'total_time': total_time, 'blocks': reports}, fp, indent=4)
+
+    return 0 if all(r['success'] for r in reports) else 1
+
+
+def search_seeds_command(args):
+    from seed_registry import SeedRegistry, search_seeds
+
+    registry = SeedRegistry(args.registry)
+    params = dict(prob_cp=args.prob_cp, num_trials=args.num_trials, marginal_tolerance=args.marginal_tolerance,
+                  method=args.method, max_attempts=args.max_attempts)
+    outcomes = search_seeds(params, range(args.first_seed, args.first_seed + args.num_seeds),
+                            num_wanted=args.num_wanted, processes=args.processes, registry=registry)
+
+    print(f"{'seed':>8}{'success':>10}{'attempts':>10}{'gen (s)':>10}")
+    for o in outcomes:
+        print(f"{o['seed']:>8}{str(o['success']):>10}{o['attempt_number']:>10}{o['generation_time']:>10.3f}")
+    good_seeds = registry.good_seeds(params)
+    print(f'{len(outcomes)} seeds tried, {len(good_seeds)} known good seeds for these parameters')
+    return 0 if args.num_wanted is None or len(good_seeds) >= args.num_wanted else 1
+
+
+def pack_command(args):
+    from library_archive import pack_library
+
+    pack_library(args.directory, args.archive)
+    return 0
+
+
+def export_command(args):
+    from library_archive import LibraryArchive
+
+    written = LibraryArchive(args.archive).export(args.out_dir, names=args.members, as_csv=args.csv)
+    print(f'{len(written)} files written to {args.out_dir}')
+    return 0
+
+
+def quest_fits_command(args):
+    from quest_index import QuestIndex
+
+    index = QuestIndex(args.data_dir, index_filename=args.index, processes=args.processes)
+    if args.session is not None:
+        for params in index.session_fits(args.session):
+            print(' '.join(f'{p:g}' for p in params))
+        return 0
+
+    print(f"{'subject':<36}{'session':<12}{'session tag':<20}params")
+    for subject, fit in sorted(index.latest_fits(args.metadata).items()):
+        print(f"{subject:<36}{fit['session']:<12}{fit['session_tag']:<20}{' '.join(f'{p:g}' for p in fit['params'])}")
+    return 0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='tools to generate and manage blocks of trials')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='generate a single block and save it with its metadata')
+    generate.add_argument('filename', help='data file to write, with a .csv or .npy extension')
+    generate.add_argument('--prob-cp', type=float, default=0)
+    generate.add_argument('--num-trials', type=int, default=204)
+    generate.add_argument('--seed', type=int, default=1)
+    generate.add_argument('--spawn-key', type=int, nargs='*', default=[])
+    generate.add_argument('--marginal-tolerance', type=float, default=0.05)
+    generate.add_argument('--method', default='rejection', choices=['rejection', 'quota', 'stream'])
+    generate.add_argument('--max-attempts', type=int, default=10000)
+    generate.add_argument('--checkpoints', type=int, nargs='+', default=None,
+                          help='prefix lengths which should meet the conditions too, best with --method stream')
+    generate.add_argument('--preflight', action='store_true',
+                          help='with --method rejection, skip generation when it is unlikely to succeed')
+    generate.set_defaults(func=generate_command)
+
+    verify = subparsers.add_parser('verify', help='check block files against the MD5 of their metadata '
+                                                  '(metadata only, numpy and pandas are not imported)')
+    verify.add_argument('paths', nargs='+', help='data files, library directories or library archives')
+    verify.add_argument('--quiet', action='store_true', help='only print failures and the summary')
+    verify.set_defaults(func=verify_command)
+
+    inspect = subparsers.add_parser('inspect', help='print the metadata of blocks '
+                                                    '(metadata only, numpy and pandas are not imported)')
+    inspect.add_argument('paths', nargs='+', help='data or metadata files, library directories or library archives')
+    inspect.add_argument('--json', action='store_true', help='print the full metadata in JSON')
+    inspect.set_defaults(func=inspect_command)
+
+    count = subparsers.add_parser('count', help='count trials per combination of independent variables, pooled over '
+                                                'the blocks of a library which share a prob_cp value')
+    count.add_argument('directory', help='library directory, e.g. Blocks003')
+    count.add_argument('--ind-vars', nargs='+', default=['coh', 'cp', 'vd'], choices=['coh', 'vd', 'dir', 'cp'])
+    count.add_argument('--prob-cp', type=float, default=None, help='only count blocks with this value (default: all)')
+    count.add_argument('--num-trials', type=int, default=None,
+                       help='only count the first trials of each block, e.g. 200 (default: all trials)')
+    count.add_argument('--keep-zeros', action='store_true', help='keep the combinations without trials')
+    count.add_argument('--output', default=None, help='csv file to write (default: print the counts)')
+    count.set_defaults(func=count_command)
+
+    build = subparsers.add_parser('build-library', help='generate all blocks of a schedule in parallel')
+    build.add_argument('out_dir', help='directory where block files are written')
+    build.add_argument('--schedule', default='DefaultBlockSequence.csv', help='block schedule csv file')
+    build.add_argument('--prob-cp', type=float, nargs='+', default=None,
+                       help='prob_cp value of each dual-report block, in schedule order '
+                            '(default: balanced random sequence drawn from the root seed)')
+    build.add_argument('--root-seed', type=int, default=1, help='seed from which all block seeds derive')
+    build.add_argument('--marginal-tolerance', type=float, default=0.01)
+    build.add_argument('--num-trials', type=int, default=None,
+                       help='number of trials per block (default: value from the schedule)')
+    build.add_argument('--method', default='rejection', choices=['rejection', 'quota', 'stream'])
+    build.add_argument('--max-attempts', type=int, default=10000)
+    build.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    build.add_argument('--cache-dir', default=None, help='directory of the block cache (default: no cache)')
+    build.add_argument('--cache-max-mb', type=float, default=None, help='size limit of the block cache, in MB')
+    build.add_argument('--joint', action='store_true',
+                       help='generate all blocks together, so that the counts pooled over the blocks sharing a '
+                            'prob_cp value are balanced too (--method, --max-attempts, --processes and the cache '
+                            'options are ignored)')
+    build.add_argument('--prefix', type=int, default=None,
+                       help='with --joint, number of trials from the start of each block balanced on their own, '
+                            'e.g. 200 to match trial_counts.py')
+    build.add_argument('--seed-registry', default=None,
+                       help='seed registry file. If provided, blocks use known-good seeds from the registry '
+                            'instead of seeds derived from the root seed, and missing ones are searched first')
+    build.set_defaults(func=build_library_command)
+
+    search = subparsers.add_parser('search-seeds', help='search seeds which yield a valid block, in parallel')
+    search.add_argument('registry', help='seed registry file, created if needed')
+    search.add_argument('--prob-cp', type=float, required=True)
+    search.add_argument('--num-trials', type=int, default=204)
+    search.add_argument('--marginal-tolerance', type=float, default=0.01)
+    search.add_argument('--method', default='rejection', choices=['rejection', 'quota', 'stream'])
+    search.add_argument('--max-attempts', type=int, default=10000)
+    search.add_argument('--first-seed', type=int, default=1)
+    search.add_argument('--num-seeds', type=int, default=100, help='number of seeds to try, at most')
+    search.add_argument('--num-wanted', type=int, default=None,
+                        help='stop once the registry knows this many good seeds (default: try all seeds)')
+    search.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    search.set_defaults(func=search_seeds_command)
+
+    pack = subparsers.add_parser('pack', help='store all files of a library directory in a single archive file')
+    pack.add_argument('directory', help='library directory, e.g. Blocks003')
+    pack.add_argument('archive', help='archive file to write')
+    pack.set_defaults(func=pack_command)
+
+    export = subparsers.add_parser('export', help='write the files of a library archive back as loose files')
+    export.add_argument('archive', help='archive file written by the pack command')
+    export.add_argument('out_dir', help='directory where files are written')
+    export.add_argument('--members', nargs='+', default=None,
+                        help='members to export, e.g. Block3.csv (default: all of them). The metadata files of '
+                             'blocks are exported along with their data files')
+    export.add_argument('--csv', action='store_true', help='convert blocks stored as npy files into csv files')
+    export.set_defaults(func=export_command)
+
+    quest = subparsers.add_parser('quest-fits', help='Quest parameters from the console dump logs of the sessions')
+    quest.add_argument('data_dir', help='directory with one folder per session, e.g. SingleCP_DotsReversal/raw')
+    quest.add_argument('--metadata', default='subj_metadata.json', help='subject metadata file')
+    quest.add_argument('--session', default=None,
+                       help='session tag, e.g. 2019_04_29_11_04. If provided, all records of this session are '
+                            'printed instead of the latest fit per subject')
+    quest.add_argument('--index', default=None, help='index file (default: quest_index.json in data_dir)')
+    quest.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    quest.set_defaults(func=quest_fits_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+This module stores a whole library of blocks (e.g. the content of a Blocks003/ folder) in a single archive file
+
+The archive holds every file of the library directory: the data and metadata files of the blocks, and auxiliary
+files such as trial_comb_count.csv or build_report.json. Its layout is:
+  - ARCHIVE_MAGIC (8 bytes)
+  - length of the index, as a little-endian unsigned 64-bit integer
+  - the index, in JSON: offset, size and MD5 of every member, and the parsed metadata of every block
+  - the content of the members, one after the other
+Opening an archive only reads its index, and a single member is read with one seek, without reading the others.
+
+Example usage:
+  >>>> pack_library('Blocks003', 'Blocks003.trials')
+  >>>> archive = LibraryArchive('Blocks003.trials')
+  >>>> archive.block_names()
+  >>>> trials = archive.load('Block3.csv')  # MD5 verified
+  >>>> archive.export('Blocks003_copy')  # loose files, as read by topsTreeNodeTaskSingleCPDotsReversal through csvFile
+"""
+import hashlib
+import json
+import os
+import struct
+
+from trial_files import DATA_FORMATS, atomic_path, standard_meta_filename, write_atomically
+
+ARCHIVE_MAGIC = b'TRIALLIB'
+ARCHIVE_VERSION = 1
+HEADER_FORMAT = '<8sQ'  # magic, index length
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# files of a library directory which are derived from the others and would be stale once exported
+SKIPPED_FILES = {'block_manifest.json'}
+
+
+def library_block_names(filenames):
+    """
+    :param filenames: (list of str) file names of a library directory
+    :return: sorted list of the data files (in any of trial_gen.DATA_FORMATS) which have a metadata file
+    """
+    return sorted(f for f in filenames
+                  if os.path.splitext(f)[1][1:] in DATA_FORMATS and standard_meta_filename(f) in filenames)
+
+
+def is_archive(filename):
+    """
+    :param filename: (str) path to a file
+    :return: (bool) whether the file starts with ARCHIVE_MAGIC
+    """
+    with open(filename, 'rb') as fp:
+        return fp.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def pack_library(directory, archive_filename):
+    """
+    writes all files of a library directory into a single archive file. Subdirectories are ignored
+    :param directory: (str) library directory
+    :param archive_filename: (str) archive file, written atomically
+    :return: (dict) index of the archive
+    """
+    filenames = sorted(f for f in os.listdir(directory)
+                       if os.path.isfile(os.path.join(directory, f)) and f not in SKIPPED_FILES)
+
+    members, contents, offset = {}, [], 0
+    for f in filenames:
+        with open(os.path.join(directory, f), 'rb') as fp:
+            content = fp.read()
+        members[f] = {'offset': offset, 'size': len(content), 'md5': hashlib.md5(content).hexdigest()}
+        contents.append(content)
+        offset += len(content)
+
+    blocks = {}
+    for f in library_block_names(filenames):
+        meta_data = json.loads(contents[filenames.index(standard_meta_filename(f))])
+        assert meta_data['csv_md5'] == members[f]['md5'], f'MD5 check failed for {f}!'
+        blocks[f] = {'metadata_file': standard_meta_filename(f), 'meta_data': meta_data}
+
+    index = {'version': ARCHIVE_VERSION, 'members': members, 'blocks': blocks}
+    index_bytes = json.dumps(index).encode()
+    with atomic_path(archive_filename) as tmp_filename:
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(struct.pack(HEADER_FORMAT, ARCHIVE_MAGIC, len(index_bytes)))
+            fp.write(index_bytes)
+            for content in contents:
+                fp.write(content)
+    print(f'{len(blocks)} blocks and {len(members) - 2 * len(blocks)} other files packed into {archive_filename}')
+    return index
+
+
+class LibraryArchive:
+    """
+    read access to a library archive written by pack_library(). Members are checked against their MD5 when read
+    """
+    def __init__(self, filename):
+        """
+        :param filename: (str) archive file. Only its header and index are read
+        """
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            magic, index_size = struct.unpack(HEADER_FORMAT, fp.read(HEADER_SIZE))
+            assert magic == ARCHIVE_MAGIC, f'{filename} is not a library archive'
+            index = json.loads(fp.read(index_size))
+        assert index['version'] == ARCHIVE_VERSION, f'unsupported archive version in {filename}'
+        self.members = index['members']
+        self.blocks = index['blocks']
+        self.data_offset = HEADER_SIZE + index_size
+
+    def names(self):
+        """
+        :return: sorted list of all member names
+        """
+        return sorted(self.members)
+
+    def block_names(self, prob_cp=None):
+        """
+        :param prob_cp: (float or None) if provided, only blocks with this prob_cp value are listed
+        :return: sorted list of the names of the data members of the blocks
+        """
+        return sorted(f for f, block in self.blocks.items()
+                      if prob_cp is None or block['meta_data']['prob_cp'] == prob_cp)
+
+    def meta_data(self, name):
+        """
+        :param name: (str) name of the data member of a block
+        :return: (dict) metadata of the block, read from the index
+        """
+        return self.blocks[name]['meta_data']
+
+    def read(self, name, verify_md5=True):
+        """
+        :param name: (str) member name
+        :param verify_md5: (bool) whether to check the content against the MD5 of the index
+        :return: (bytes) content of the member
+        """
+        member = self.members[name]
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self.data_offset + member['offset'])
+            content = fp.read(member['size'])
+        if verify_md5:
+            assert hashlib.md5(content).hexdigest() == member['md5'], f'MD5 check failed for {name}!'
+        return content
+
+    def load(self, name, verify_md5=True):
+        """
+        :param name: (str) name of the data member of a block
+        :param verify_md5: (bool) whether to check the data against its MD5
+        :return: Trials object, see trial_gen.Trials.from_bytes()
+        """
+        from trial_gen import Trials  # numpy and pandas are only imported when blocks are decoded
+
+        return Trials.from_bytes(self.read(name, verify_md5=False), self.meta_data(name), verify_md5=verify_md5)
+
+    def export(self, out_dir, names=None, as_csv=False):
+        """
+        writes members of the archive as loose files, identical to the packed ones
+        :param out_dir: (str) directory where files are written, created if needed
+        :param names: (list of str or None) members to export, with the metadata members of the blocks among them.
+                      If None, all members are exported
+        :param as_csv: (bool) if True, blocks stored in the npy format are converted to csv files (with new
+                       metadata files), since the MATLAB task only reads csv files
+        :return: (list of str) paths of the written files
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        if names is None:
+            names = self.names()
+        else:
+            names = sorted(set(names) | {self.blocks[f]['metadata_file'] for f in names if f in self.blocks})
+
+        converted = [f for f in names if as_csv and f in self.blocks
+                     and self.meta_data(f).get('data_format', 'csv') == 'npy']
+        skipped = {self.blocks[f]['metadata_file'] for f in converted}
+
+        written = []
+        for name in names:
+            if name in skipped:
+                continue
+            filename = os.path.join(out_dir, name)
+            if name in converted:
+                filename = os.path.splitext(filename)[0] + '.csv'
+                self.load(name).save_to_csv(filename)
+                written += [filename, standard_meta_filename(filename)]
+            else:
+                write_atomically(filename, self.read(name))
+                written.append(filename)
+        return written
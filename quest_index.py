@@ -0,0 +1,220 @@
+"""
+This module indexes the Quest parameters printed in the console dump logs of the sessions, and answers queries such as
+the latest Quest fit of each subject
+
+It replaces the grep calls of data/show_quest_params.sh. Each log file raw/<session tag>/consoleDump_<session tag>.log
+is memory-mapped and only the bytes following each occurrence of QUEST_MARKER are parsed, i.e. lines of the form
+  psiParamsQuest =
+  <blank line>
+     12.0000    3.5000    0.5000         0
+The parsed records are stored in an index file, with the mtime and size of each log. Refreshing the index only parses
+the new or modified logs, in parallel. Subjects are matched to sessions through the sessionTag fields of
+subj_metadata.json, which also holds the QuestFit of completed Quest blocks (see getLatestQuestParams.m).
+
+Example usage:
+  >>>> index = QuestIndex('SingleCP_DotsReversal/raw')  # creates or refreshes raw/quest_index.json
+  >>>> index.session_fits('2019_04_29_11_04')
+  >>>> index.latest_fits('subj_metadata.json')  # latest Quest fit per subject
+"""
+import json
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from trial_files import write_atomically
+
+QUEST_MARKER = b'psiParamsQuest'
+INDEX_FILENAME = 'quest_index.json'
+INDEX_VERSION = 1
+LOG_PATTERN = re.compile(r'^consoleDump_(?P<tag>\d{4}_\d{2}_\d{2}_\d{2}_\d{2})\.log$')
+MAX_RECORD_LINES = 16  # lines read after the marker, at most
+_ASSIGNMENT = re.compile(rb'^psiParamsQuest\s*=(?P<rest>.*)$')
+_SCALE_FACTOR = re.compile(rb'^\s*(?P<factor>[-+.\deE]+)\s*\*\s*$')
+_COLUMNS_HEADER = re.compile(rb'^\s*Columns? \d+')
+
+
+def _parse_numbers(line):
+    """
+    :param line: (bytes)
+    :return: (list of float or None) the numbers of the line, None if the line holds anything else
+    """
+    try:
+        return [float(token) for token in line.split()]
+    except ValueError:
+        return None
+
+
+def parse_record(buffer, position):
+    """
+    parses the parameters displayed by MATLAB for psiParamsQuest, e.g. in the console dump of a session
+    :param buffer: (bytes-like) content of a log file, e.g. a memory map
+    :param position: (int) position of an occurrence of QUEST_MARKER in buffer
+    :return: (list of float or None) the parameters, None if the marker is not part of a display of psiParamsQuest
+    """
+    line_start = buffer.rfind(b'\n', 0, position) + 1
+    lines = []
+    start = line_start
+    for _ in range(MAX_RECORD_LINES + 1):
+        end = buffer.find(b'\n', start)
+        if end == -1:
+            end = len(buffer)
+        lines.append(bytes(buffer[start:end]).rstrip(b'\r'))
+        if end == len(buffer):
+            break
+        start = end + 1
+
+    match = _ASSIGNMENT.match(lines[0].lstrip())
+    if match is None:
+        return None
+    if match.group('rest').strip():  # format compact, e.g. psiParamsQuest = 12 3.5 0.5 0, or a line of code
+        return _parse_numbers(match.group('rest')) or None
+
+    params, scale = [], 1
+    chunk_started = False  # wide displays are split in chunks of columns, each under a 'Columns ...' header
+    for pos, line in enumerate(lines[1:], 1):
+        if not line.strip():
+            following = [next_line for next_line in lines[pos + 1:] if next_line.strip()]
+            if chunk_started and not (following and _COLUMNS_HEADER.match(following[0])):
+                break
+            continue
+        if _COLUMNS_HEADER.match(line):
+            chunk_started = False
+            continue
+        factor = _SCALE_FACTOR.match(line)
+        if factor is not None and not params:
+            scale = float(factor.group('factor'))
+            continue
+        numbers = _parse_numbers(line)
+        if numbers is None:
+            break
+        params += numbers
+        chunk_started = True
+    return [scale * p for p in params] or None
+
+
+def parse_log(filename):
+    """
+    finds all Quest parameter records of a log file, without reading the rest of the file into Python objects
+    :param filename: (str) path to a console dump log
+    :return: (list of dicts) one dict per record, with the byte offset of the record and the parameters, in file order
+    """
+    records = []
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return records
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            position = buffer.find(QUEST_MARKER)
+            while position != -1:
+                params = parse_record(buffer, position)
+                if params is not None:
+                    records.append({'offset': position, 'params': params})
+                position = buffer.find(QUEST_MARKER, position + len(QUEST_MARKER))
+    return records
+
+
+def _log_signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class QuestIndex:
+    """
+    index of the Quest parameter records of all console dump logs below a data directory, keyed by session tag
+
+    The index is stored in the data directory as INDEX_FILENAME. Each entry holds the log file name (relative to the
+    data directory), its mtime and size, and its records as returned by parse_log().
+    """
+    def __init__(self, data_dir, index_filename=None, refresh=True, processes=None):
+        """
+        :param data_dir: (str) directory searched recursively for console dump logs, e.g. SingleCP_DotsReversal/raw
+        :param index_filename: (str or None) index file, data_dir/INDEX_FILENAME if None
+        :param refresh: (bool) whether to bring the index up to date with the logs right away
+        :param processes: (int or None) number of worker processes used to parse logs, see self.refresh()
+        """
+        self.data_dir = data_dir
+        self.index_filename = os.path.join(data_dir, INDEX_FILENAME) if index_filename is None else index_filename
+        self.sessions = {}
+
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'r') as fp:
+                index = json.load(fp)
+            if index.get('version') == INDEX_VERSION:
+                self.sessions = index['sessions']
+
+        if refresh:
+            self.refresh(processes=processes)
+
+    def log_files(self):
+        """
+        :return: (dict) path of each console dump log below self.data_dir, relative to it, keyed by session tag
+        """
+        logs = {}
+        for root, _, filenames in os.walk(self.data_dir):
+            for f in filenames:
+                match = LOG_PATTERN.match(f)
+                if match is not None:
+                    logs[match.group('tag')] = os.path.relpath(os.path.join(root, f), self.data_dir)
+        return logs
+
+    def refresh(self, processes=None):
+        """
+        brings the index up to date with the logs: new or modified logs are (re-)parsed, in parallel, entries of
+        deleted logs are dropped, and unchanged logs are skipped. The index file is rewritten only if something changed
+        :param processes: (int or None) number of worker processes. None uses all cores, 1 parses in the current process
+        :return: (int) number of logs that were (re-)parsed
+        """
+        logs = self.log_files()
+        removed = set(self.sessions) - set(logs)
+        for tag in removed:
+            del self.sessions[tag]
+
+        signatures = {tag: _log_signature(os.path.join(self.data_dir, f)) for tag, f in logs.items()}
+        changed = sorted(tag for tag, f in logs.items()
+                         if tag not in self.sessions or self.sessions[tag]['log_file'] != f
+                         or self.sessions[tag]['signature'] != signatures[tag])
+        filenames = [os.path.join(self.data_dir, logs[tag]) for tag in changed]
+
+        if processes == 1 or len(changed) < 2:
+            all_records = [parse_log(f) for f in filenames]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                all_records = list(executor.map(parse_log, filenames))
+
+        for tag, records in zip(changed, all_records):
+            self.sessions[tag] = {'log_file': logs[tag], 'signature': signatures[tag], 'records': records}
+
+        if changed or removed or not os.path.exists(self.index_filename):
+            self.save()
+        return len(changed)
+
+    def save(self):
+        index = {'version': INDEX_VERSION, 'sessions': self.sessions}
+        write_atomically(self.index_filename, json.dumps(index).encode())
+
+    def session_fits(self, session_tag):
+        """
+        :param session_tag: (str) e.g. '2019_04_29_11_04'
+        :return: (list of lists of float) Quest parameters printed during the session, in order
+        """
+        return [r['params'] for r in self.sessions.get(session_tag, {'records': []})['records']]
+
+    def latest_fits(self, metadata_filename='subj_metadata.json'):
+        """
+        latest Quest fit of each subject of the metadata file, among the sessions with records in the index. Session
+        tags are timestamps, so the latest session is the one with the largest tag
+        :param metadata_filename: (str) subject metadata file, as written by topsTreeNodeTaskSingleCPDotsReversal
+        :return: (dict) keyed by subject code, with the session name, session tag and parameters of the last record
+                 of the latest session. Subjects without records are left out
+        """
+        with open(metadata_filename, 'r') as fp:
+            subjects = json.load(fp)
+
+        fits = {}
+        for subject, sessions in subjects.items():
+            tagged = [(s['sessionTag'], name) for name, s in sessions.items()
+                      if isinstance(s, dict) and self.session_fits(s.get('sessionTag'))]
+            if tagged:
+                tag, name = max(tagged)
+                fits[subject] = {'session': name, 'session_tag': tag, 'params': self.session_fits(tag)[-1]}
+        return fits
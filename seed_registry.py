@@ -0,0 +1,191 @@
+"""
+This module searches seeds which yield a valid block of trials, in parallel, and keeps the outcome of every searched
+seed in a persistent registry, so that later builds only use known-good seeds
+
+Seeds are searched with spawn_key=(), for a parameter set made of all the other kwargs of Trials(). The registry is
+a JSON file where parameter sets are keyed by a hash of their generation inputs (see trial_cache.canonical_inputs()),
+and where each searched seed is stored with its success, attempt count and empirical marginals.
+
+Example usage:
+  >>>> registry = SeedRegistry('seed_registry.json')
+  >>>> params = dict(prob_cp=0.8, num_trials=250, marginal_tolerance=0.01, max_attempts=2000)
+  >>>> search_seeds(params, range(1, 101), num_wanted=10, registry=registry)  # registry file updated
+  >>>> registry.good_seeds(params)
+  >>>> trials = Trials(seed=registry.good_seeds(params)[0], **params)  # cannot fail
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from trial_cache import canonical_inputs
+from trial_gen import Trials, write_atomically
+
+REGISTRY_VERSION = 1
+SEED_KWARGS = ('seed', 'spawn_key')  # kwargs of Trials() which vary within a parameter set
+
+
+def parameter_inputs(params):
+    """
+    :param params: (dict) kwargs of Trials(), without seed and spawn_key
+    :return: (dict) canonical generation inputs of the parameter set, see trial_cache.canonical_inputs()
+    """
+    assert not set(params) & set(SEED_KWARGS), f'{SEED_KWARGS} are not part of a parameter set'
+    inputs = canonical_inputs(**params)
+    for k in SEED_KWARGS:
+        del inputs[k]
+    return inputs
+
+
+def parameter_key(params):
+    """
+    :param params: (dict) kwargs of Trials(), without seed and spawn_key
+    :return: (str) hexadecimal SHA-256 digest identifying the parameter set
+    """
+    return hashlib.sha256(json.dumps(parameter_inputs(params), sort_keys=True).encode()).hexdigest()
+
+
+def try_seed(job):
+    """
+    generates a single block. Module-level function so that it can be sent to worker processes
+    :param job: (tuple) (params, seed), where params are kwargs of Trials() without seed and spawn_key
+    :return: (dict) outcome of the generation
+    """
+    params, seed = job
+    start = time.perf_counter()
+    trials = Trials(seed=seed, **params)
+    return {
+        'seed': seed,
+        'success': trials.trial_data is not None,
+        'attempt_number': trials.attempt_number,
+        'empirical_marginals': trials.empirical_marginals,
+        'generation_time': time.perf_counter() - start
+    }
+
+
+class SeedRegistry:
+    """
+    persistent record of the outcome of searched seeds, per parameter set
+
+    The registry file is written with trial_gen.write_atomically(). Before writing, entries recorded in the file by
+    other processes since it was read are merged in, so that several searches may share a registry file.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: (str) JSON file of the registry, created on first save if it does not exist
+        """
+        self.filename = filename
+        self.parameter_sets = self._read()
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            return {}
+        with open(self.filename, 'r') as fp:
+            registry = json.load(fp)
+        assert registry.get('version') == REGISTRY_VERSION, f'unsupported registry version in {self.filename}'
+        return registry['parameter_sets']
+
+    def save(self):
+        on_disk = self._read()
+        for key, entry in on_disk.items():
+            mine = self.parameter_sets.setdefault(key, entry)
+            for seed, outcome in entry['seeds'].items():
+                mine['seeds'].setdefault(seed, outcome)
+        registry = {'version': REGISTRY_VERSION, 'parameter_sets': self.parameter_sets}
+        write_atomically(self.filename, json.dumps(registry, indent=4).encode())
+
+    def record(self, params, outcomes):
+        """
+        adds seed outcomes to the registry, in memory. Call self.save() to write them
+        :param params: (dict) kwargs of Trials(), without seed and spawn_key
+        :param outcomes: (list of dicts) as returned by try_seed()
+        :return: None
+        """
+        entry = self.parameter_sets.setdefault(parameter_key(params),
+                                               {'parameters': parameter_inputs(params), 'seeds': {}})
+        for outcome in outcomes:
+            # JSON object keys are strings
+            entry['seeds'][str(outcome['seed'])] = {k: v for k, v in outcome.items() if k != 'seed'}
+
+    def outcomes(self, params):
+        """
+        :param params: (dict) kwargs of Trials(), without seed and spawn_key
+        :return: (dict) outcome of each searched seed, keyed by seed (int)
+        """
+        entry = self.parameter_sets.get(parameter_key(params), {'seeds': {}})
+        return {int(seed): outcome for seed, outcome in entry['seeds'].items()}
+
+    def good_seeds(self, params):
+        """
+        :param params: (dict) kwargs of Trials(), without seed and spawn_key
+        :return: sorted list of the seeds known to yield a valid block
+        """
+        return sorted(seed for seed, outcome in self.outcomes(params).items() if outcome['success'])
+
+
+def search_seeds(params, seeds, num_wanted=None, processes=None, registry=None):
+    """
+    tries seeds in parallel, in order, until num_wanted of them yield a valid block within params['max_attempts']
+    attempts. Seeds already in the registry are not tried again. Seeds are sent to the workers in rounds, so that
+    little work is wasted past the wanted number of good seeds
+    :param params: (dict) kwargs of Trials(), without seed and spawn_key
+    :param seeds: iterable of int, seeds to try
+    :param num_wanted: (int or None) number of good seeds after which the search stops, including those already in
+                       the registry. If None, all seeds are tried
+    :param processes: (int or None) number of worker processes. None uses all cores, 1 runs in the current process
+    :param registry: (SeedRegistry or None) if provided, known outcomes are skipped, and new ones are recorded and
+                     saved after each round
+    :return: list of outcomes as returned by try_seed(), for the seeds tried by this call
+    """
+    known = {} if registry is None else registry.outcomes(params)
+    num_good = sum(outcome['success'] for outcome in known.values())
+    pending = [seed for seed in seeds if seed not in known]
+    round_size = processes or os.cpu_count() or 1
+    if num_wanted is None:
+        round_size = len(pending)
+
+    outcomes = []
+    with ProcessPoolExecutor(max_workers=processes) if processes != 1 else nullcontext() as executor:
+        mapper = map if executor is None else executor.map
+        while pending and (num_wanted is None or num_good < num_wanted):
+            batch = pending[:round_size]
+            pending = pending[len(batch):]
+            new_outcomes = list(mapper(try_seed, [(params, seed) for seed in batch]))
+            outcomes += new_outcomes
+            num_good += sum(outcome['success'] for outcome in new_outcomes)
+            if registry is not None:
+                registry.record(params, new_outcomes)
+                registry.save()
+    return outcomes
+
+
+def pick_seeds(params, count, registry, processes=None, first_seed=1, max_seeds=10000, exclude=()):
+    """
+    picks count distinct known-good seeds for a parameter set, searching more seeds when the registry does not know
+    enough of them
+    :param params: (dict) kwargs of Trials(), without seed and spawn_key
+    :param count: (int) number of seeds needed
+    :param registry: SeedRegistry
+    :param processes: passed to search_seeds()
+    :param first_seed: (int) first seed to try when searching
+    :param max_seeds: (int) largest number of seeds tried by this call
+    :param exclude: (set of int) seeds which should not be picked, e.g. those of other blocks of a library. Blocks
+                    with the same seed share their random draws, even when their parameters differ
+    :return: list of the count smallest good seeds which are not excluded
+    """
+    def available():
+        return [seed for seed in registry.good_seeds(params) if seed not in exclude]
+
+    good = available()
+    if len(good) < count:
+        # seeds are tried in increasing order, past the largest seed searched so far
+        start = max(list(registry.outcomes(params)) + [first_seed - 1]) + 1
+        num_excluded = len(registry.good_seeds(params)) - len(good)
+        search_seeds(params, (seed for seed in range(start, start + max_seeds) if seed not in exclude),
+                     num_wanted=count + num_excluded, processes=processes, registry=registry)
+        good = available()
+        assert len(good) >= count, f'only {len(good)} good seeds were found, {count} are needed. ' \
+                                   f'You may increase max_attempts or marginal_tolerance'
+    return good[:count]
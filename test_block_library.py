@@ -0,0 +1,83 @@
+"""
+tests of the block library builders and index of block_library.py, run with: python -m pytest -q
+"""
+import os
+
+import numpy as np
+import pytest
+
+from block_library import BlockLibrary, build_block_set, library_jobs
+from trial_gen import ALLOWED_PROB_CP, Trials, count_tensor
+
+SCHEDULE = [('Tut1', 10), ('Block2', 250)] + [(f'Block{i}', 250) for i in range(3, 12)]
+
+
+def quota_tensor(trials, n):
+    """
+    :return: count tensor of the target counts of Trials.quota_counts(n)
+    """
+    return count_tensor(trials.counts_to_trials(*trials.quota_counts(n)))
+
+
+@pytest.mark.parametrize('prefix', [None, 200])
+def test_block_set_meets_conditions_and_pooled_targets(tmp_path, prefix):
+    jobs = library_jobs(SCHEDULE, None, root_seed=5, out_dir=str(tmp_path), marginal_tolerance=0.01)
+    reports = build_block_set(jobs, prefix=prefix)
+    assert all(r['success'] for r in reports)
+
+    library = BlockLibrary(str(tmp_path))
+    assert len(library.entries) == len(jobs)
+    for job in jobs:
+        trials = Trials(**dict(job['trials_kwargs'], generate=False))
+        loaded = Trials(from_file=job['filename'])
+        assert loaded.method == 'block_set'
+        assert trials.check_conditions(loaded.trial_data, append_marginals=False)
+        if prefix is not None:
+            assert trials.checkpoint_checks(loaded.trial_data, [prefix]).all()
+
+    for prob_cp in ALLOWED_PROB_CP:
+        group = [job for job in jobs if job['trials_kwargs']['prob_cp'] == prob_cp]
+        template = Trials(**dict(group[0]['trials_kwargs'], generate=False))
+        num_trials = sum(job['trials_kwargs']['num_trials'] for job in group)
+        if prefix is None:
+            assert np.array_equal(library.count_tensor(prob_cp=prob_cp), quota_tensor(template, num_trials))
+        else:
+            # the prefixes and the rest of the blocks hit their pooled targets separately
+            pooled_prefix = library.count_tensor(prob_cp=prob_cp, num_trials=prefix)
+            assert np.array_equal(pooled_prefix, quota_tensor(template, prefix * len(group)))
+            assert np.array_equal(library.count_tensor(prob_cp=prob_cp) - pooled_prefix,
+                                  quota_tensor(template, num_trials - prefix * len(group)))
+
+
+def test_refresh_reindexes_only_modified_files(tmp_path):
+    for seed in [1, 2, 3]:
+        Trials(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, seed=seed).save_to_csv(
+            str(tmp_path / f'Block{seed}.csv'))
+    library = BlockLibrary(str(tmp_path))
+    assert library.select() == ['Block1.csv', 'Block2.csv', 'Block3.csv']
+    assert library.refresh() == 0
+
+    # another block replaces Block2.csv, with an mtime set explicitly in case the file system has a coarse resolution
+    modified = str(tmp_path / 'Block2.csv')
+    Trials(prob_cp=0.2, num_trials=204, marginal_tolerance=0.05, seed=4).save_to_csv(modified)
+    os.utime(modified, ns=(os.stat(modified).st_atime_ns, os.stat(modified).st_mtime_ns + 10 ** 9))
+    assert library.refresh() == 1
+    assert library.entries['Block2.csv']['prob_cp'] == 0.2
+
+    # a new object reads the manifest, and deleted blocks are dropped without re-indexing the others
+    os.remove(str(tmp_path / 'Block3.csv'))
+    library = BlockLibrary(str(tmp_path), refresh=False)
+    assert library.refresh() == 0
+    assert library.select() == ['Block1.csv', 'Block2.csv']
+    assert library.select(prob_cp=0.2) == ['Block2.csv']
+
+
+def test_npy_blocks_are_indexed_like_csv_blocks(tmp_path):
+    for seed in [1, 2]:
+        trials = Trials(prob_cp=0.5, num_trials=204, marginal_tolerance=0.05, seed=seed)
+        for fmt in ['csv', 'npy']:
+            trials.save_to_csv(str(tmp_path / f'Block{seed}.{fmt}'))
+    library = BlockLibrary(str(tmp_path))
+    for seed in [1, 2]:
+        assert library.entries[f'Block{seed}.npy']['cell_codes'] == library.entries[f'Block{seed}.csv']['cell_codes']
+        assert library.entries[f'Block{seed}.npy']['spawn_key'] == []
@@ -0,0 +1,83 @@
+"""
+tests of the library archive of library_archive.py, run with: python -m pytest -q
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from cli import main
+from library_archive import LibraryArchive, is_archive, pack_library
+from trial_gen import Trials, standard_meta_filename
+
+
+@pytest.fixture
+def library(tmp_path):
+    """
+    :return: (str) library directory with a csv block, an npy block and an auxiliary file
+    """
+    directory = tmp_path / 'Blocks003'
+    directory.mkdir()
+    Trials(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, seed=1).save_to_csv(str(directory / 'Block1.csv'))
+    Trials(prob_cp=0.2, num_trials=204, marginal_tolerance=0.05, seed=2).save_to_csv(str(directory / 'Block2.npy'))
+    (directory / 'notes.txt').write_bytes(b'auxiliary file\n')
+    return str(directory)
+
+
+def test_pack_read_load_export_round_trip(library, tmp_path):
+    archive_filename = str(tmp_path / 'Blocks003.trials')
+    pack_library(library, archive_filename)
+    assert is_archive(archive_filename)
+    assert not is_archive(os.path.join(library, 'Block1.csv'))
+
+    archive = LibraryArchive(archive_filename)
+    assert archive.names() == sorted(os.listdir(library))
+    assert archive.block_names() == ['Block1.csv', 'Block2.npy']
+    assert archive.block_names(prob_cp=0.2) == ['Block2.npy']
+    for name in archive.names():
+        with open(os.path.join(library, name), 'rb') as fp:
+            assert archive.read(name) == fp.read()
+    for name in archive.block_names():
+        loaded = archive.load(name)
+        assert np.array_equal(loaded.get_count_tensor(),
+                              Trials(from_file=os.path.join(library, name)).get_count_tensor())
+
+    out_dir = str(tmp_path / 'exported')
+    written = archive.export(out_dir)
+    assert sorted(os.path.basename(f) for f in written) == archive.names()
+    for name in archive.names():
+        with open(os.path.join(library, name), 'rb') as original, open(os.path.join(out_dir, name), 'rb') as copied:
+            assert original.read() == copied.read()
+
+
+def test_export_as_csv_converts_npy_blocks(library, tmp_path):
+    archive_filename = str(tmp_path / 'Blocks003.trials')
+    pack_library(library, archive_filename)
+    archive = LibraryArchive(archive_filename)
+
+    out_dir = str(tmp_path / 'exported')
+    written = archive.export(out_dir, names=['Block2.npy'], as_csv=True)
+    converted = os.path.join(out_dir, 'Block2.csv')
+    assert written == [converted, standard_meta_filename(converted)]
+    assert sorted(os.listdir(out_dir)) == ['Block2.csv', 'Block2_metadata.json']
+
+    trials = Trials(from_file=converted)
+    original = Trials(from_file=os.path.join(library, 'Block2.npy'))
+    assert trials.data_format == 'csv'
+    assert trials.trial_data.astype(str).equals(original.trial_data.astype(str))
+    assert np.array_equal(trials.get_count_tensor(), original.get_count_tensor())
+
+
+def test_inspect_lists_archives_and_blocks_without_data_files(library, tmp_path, capsys):
+    archive_filename = str(tmp_path / 'Blocks003.trials')
+    pack_library(library, archive_filename)
+    # the metadata of a block can be inspected when its data file is missing, as with the verify command
+    missing = os.path.join(library, 'Block1.csv')
+    os.remove(missing)
+    capsys.readouterr()
+
+    assert main(['inspect', '--json', archive_filename, missing]) == 0
+    entries = json.loads(capsys.readouterr().out)
+    assert sorted(entries) == [f'{archive_filename}:Block1.csv', f'{archive_filename}:Block2.npy', missing]
+    assert entries[missing]['seed'] == 1
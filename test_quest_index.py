@@ -0,0 +1,76 @@
+"""
+tests of the Quest parameter index of quest_index.py, run with: python -m pytest -q
+"""
+import json
+import os
+
+import pytest
+
+from quest_index import QUEST_MARKER, QuestIndex, parse_log, parse_record
+
+# displays of psiParamsQuest by MATLAB, as found in the console dump logs
+BLOCK = b'psiParamsQuest =\n\n   12.0000    3.5000    0.5000         0\n\n'
+INLINE = b'psiParamsQuest = 12 3.5 0.5 0\n'
+SCALED = b'psiParamsQuest =\n\n   1.0e+03 *\n\n    0.0120    0.0035    0.0005         0\n\n'
+COLUMNS = b'psiParamsQuest =\n\n  Columns 1 through 2\n\n   12.0000    3.5000\n\n  Columns 3 through 4\n\n' \
+          b'    0.5000         0\n\n'
+CODE = b'    psiParamsQuest = qpListMaxArg(questData.posterior, questData.psiParamsDomain);\n'
+
+
+def parse(text):
+    return parse_record(text, text.find(QUEST_MARKER))
+
+
+@pytest.mark.parametrize('display', [BLOCK, INLINE, SCALED, COLUMNS, BLOCK.replace(b'\n', b'\r\n')])
+def test_displays_are_parsed(display):
+    text = b'Starting block Quest\n' + display + b'>> next command\n'
+    assert parse(text) == pytest.approx([12, 3.5, 0.5, 0])
+
+
+def test_code_mentioning_the_marker_is_not_a_record():
+    assert parse(CODE) is None
+    assert parse(b"fprintf('psiParamsQuest is updated')\n") is None
+    assert parse(b'psiParamsQuest =\n\n>> \n') is None
+
+
+def test_records_of_a_log_are_found_in_order(tmp_path):
+    filename = str(tmp_path / 'consoleDump_2019_04_29_11_04.log')
+    with open(filename, 'wb') as fp:
+        fp.write(CODE + BLOCK + b'trial 1\n' + CODE + SCALED.replace(b'0.0120', b'0.0130'))
+    records = parse_log(filename)
+    assert len(records) == 2
+    assert records[0]['params'] == [12, 3.5, 0.5, 0]
+    assert records[1]['params'] == pytest.approx([13, 3.5, 0.5, 0])
+    assert records[0]['offset'] == len(CODE)
+
+
+def write_log(data_dir, tag, content):
+    os.makedirs(os.path.join(data_dir, tag), exist_ok=True)
+    filename = os.path.join(data_dir, tag, f'consoleDump_{tag}.log')
+    with open(filename, 'wb') as fp:
+        fp.write(content)
+    return filename
+
+
+def test_refresh_only_parses_new_or_modified_logs(tmp_path):
+    data_dir = str(tmp_path / 'raw')
+    write_log(data_dir, '2019_04_29_11_04', BLOCK)
+    write_log(data_dir, '2019_05_02_10_30', INLINE)
+    index = QuestIndex(data_dir, processes=1)
+    assert index.session_fits('2019_04_29_11_04') == [[12, 3.5, 0.5, 0]]
+
+    # a new object reads the index file, and unchanged logs are skipped
+    index = QuestIndex(data_dir, refresh=False)
+    assert index.refresh(processes=1) == 0
+
+    modified = write_log(data_dir, '2019_05_02_10_30', INLINE + BLOCK.replace(b'12.0000', b'14.0000'))
+    os.utime(modified, ns=(os.stat(modified).st_atime_ns, os.stat(modified).st_mtime_ns + 10 ** 9))
+    assert index.refresh(processes=1) == 1
+    assert index.session_fits('2019_05_02_10_30') == [[12, 3.5, 0.5, 0], [14, 3.5, 0.5, 0]]
+
+    subjects = {'S1': {'Quest': {'sessionTag': '2019_04_29_11_04'}, 'Block2': {'sessionTag': '2019_05_02_10_30'}}}
+    metadata_filename = str(tmp_path / 'subj_metadata.json')
+    with open(metadata_filename, 'w') as fp:
+        json.dump(subjects, fp)
+    assert index.latest_fits(metadata_filename) == \
+        {'S1': {'session': 'Block2', 'session_tag': '2019_05_02_10_30', 'params': [14, 3.5, 0.5, 0]}}
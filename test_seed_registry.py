@@ -0,0 +1,49 @@
+"""
+tests of the seed search and registry of seed_registry.py, run with: python -m pytest -q
+"""
+import seed_registry
+from seed_registry import SeedRegistry, pick_seeds, search_seeds
+
+# with a single attempt, some seeds fail and others yield a valid block
+PARAMS = dict(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, max_attempts=1)
+
+
+def test_search_skips_known_seeds(tmp_path, monkeypatch):
+    tried = []
+    try_seed = seed_registry.try_seed
+    monkeypatch.setattr(seed_registry, 'try_seed', lambda job: tried.append(job[1]) or try_seed(job))
+
+    registry = SeedRegistry(str(tmp_path / 'registry.json'))
+    outcomes = search_seeds(PARAMS, range(1, 6), processes=1, registry=registry)
+    assert [o['seed'] for o in outcomes] == tried == [1, 2, 3, 4, 5]
+    assert 0 < len(registry.good_seeds(PARAMS)) < 5
+
+    tried.clear()
+    registry = SeedRegistry(str(tmp_path / 'registry.json'))
+    outcomes = search_seeds(PARAMS, range(1, 9), processes=1, registry=registry)
+    assert [o['seed'] for o in outcomes] == tried == [6, 7, 8]
+    assert sorted(registry.outcomes(PARAMS)) == list(range(1, 9))
+
+
+def test_save_merges_concurrent_writers(tmp_path):
+    filename = str(tmp_path / 'registry.json')
+    other_params = dict(PARAMS, prob_cp=0.2)
+    first, second = SeedRegistry(filename), SeedRegistry(filename)
+    search_seeds(PARAMS, [1, 2], processes=1, registry=first)
+    search_seeds(PARAMS, [3, 4], processes=1, registry=second)
+    search_seeds(other_params, [1], processes=1, registry=second)
+
+    merged = SeedRegistry(filename)
+    assert sorted(merged.outcomes(PARAMS)) == [1, 2, 3, 4]
+    assert sorted(merged.outcomes(other_params)) == [1]
+
+
+def test_pick_seeds_honours_exclude(tmp_path):
+    registry = SeedRegistry(str(tmp_path / 'registry.json'))
+    search_seeds(PARAMS, range(1, 6), processes=1, registry=registry)
+    good = registry.good_seeds(PARAMS)
+    exclude = set(good[:2])
+
+    picked = pick_seeds(PARAMS, 4, registry, processes=1, exclude=exclude)
+    assert len(picked) == 4 and not set(picked) & exclude
+    assert picked == [seed for seed in registry.good_seeds(PARAMS) if seed not in exclude][:4]
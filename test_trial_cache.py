@@ -0,0 +1,69 @@
+"""
+tests of the on-disk cache of trial_cache.py, run with: python -m pytest -q
+"""
+import json
+import os
+import time
+
+from trial_cache import TrialCache, cache_key
+from trial_gen import TELEMETRY_TIMES, Trials, standard_meta_filename
+
+KWARGS = dict(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05)
+
+
+def test_hits_misses_and_least_recently_used_eviction(tmp_path):
+    cache = TrialCache(str(tmp_path), max_entries=2)
+    first = cache.get(seed=1, **KWARGS)
+    for seed in [2, 1, 3]:
+        time.sleep(0.01)  # distinct mtimes, which order the entries by last use
+        cache.get(seed=seed, **KWARGS)
+    assert cache.stats == {'hits': 1, 'misses': 3, 'evictions': 1}
+
+    # seed 2 was the least recently used entry when seed 3 was added
+    assert sorted(os.path.basename(f) for f, _, _ in cache.entries()) == \
+        sorted(cache_key(seed=seed, **KWARGS) + '.npy' for seed in [1, 3])
+    hit = cache.get(seed=1, **KWARGS)
+    assert cache.stats['hits'] == 2
+    assert hit.trial_data.equals(first.trial_data)
+
+
+def test_size_limit(tmp_path):
+    cache = TrialCache(str(tmp_path))
+    cache.get(seed=1, **KWARGS)
+    entry_size = cache.entries()[0][1]
+
+    cache = TrialCache(str(tmp_path), max_bytes=int(2.5 * entry_size))  # entry sizes differ by a few bytes
+    for seed in [2, 3]:
+        time.sleep(0.01)
+        cache.get(seed=seed, **KWARGS)
+    assert len(cache.entries()) == 2
+    assert cache.stats['evictions'] == 1
+
+
+def test_equivalent_kwargs_share_a_key(tmp_path):
+    assert cache_key(prob_cp=0) == cache_key(prob_cp=0.0)
+    assert cache_key(prob_cp=0.8, num_trials=250) == cache_key(prob_cp=0.8, num_trials=250.0)
+    assert cache_key(vd_marginals={100: .1, 200: .1, 300: .4, 400: .4}) == \
+        cache_key(vd_marginals={400: .4, 300: .4, 200.0: .1, 100: .1})
+    assert cache_key(checkpoints=[200, 100]) == cache_key(checkpoints=(100, 200))
+    assert cache_key(seed=1) != cache_key(seed=2)
+    assert cache_key(prob_cp=0.2) != cache_key(prob_cp=0.5)
+
+    cache = TrialCache(str(tmp_path))
+    cache.get(prob_cp=0, num_trials=204, marginal_tolerance=0.05)
+    cache.get(prob_cp=0.0, num_trials=204, marginal_tolerance=0.05)
+    assert cache.stats['hits'] == 1
+
+
+def test_entries_are_written_without_timings(tmp_path):
+    cache = TrialCache(str(tmp_path / 'cache'))
+    cache.get(seed=1, **KWARGS)
+    with open(standard_meta_filename(cache.entries()[0][0]), 'r') as fp:
+        telemetry = json.load(fp)['generation_telemetry']
+    assert not set(TELEMETRY_TIMES) & set(telemetry)
+
+    # blocks saved by users keep the draw/check time split
+    filename = str(tmp_path / 'Block1.npy')
+    Trials(seed=1, **KWARGS).save_to_csv(filename)
+    with open(standard_meta_filename(filename), 'r') as fp:
+        assert set(TELEMETRY_TIMES) <= set(json.load(fp)['generation_telemetry'])
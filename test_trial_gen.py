@@ -0,0 +1,230 @@
+"""
+tests of the guarantees of trial_gen.py, run with: python -m pytest -q
+"""
+import collections
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from trial_gen import ALLOWED_PROB_CP, DATA_FORMATS, GENERATION_METHODS, MARGINALS_TEMPLATE, TENSOR_AXES, Trials, \
+    count_tensor, marginal_pass_probability, materialize_trials, sample_prob_cp_seq, vd_cp_pass_probability
+
+SETTINGS = [(prob_cp, num_trials, marginal_tolerance) for prob_cp in sorted(ALLOWED_PROB_CP)
+            for num_trials, marginal_tolerance in [(204, 0.02), (250, 0.01), (400, 0.01)]]
+
+
+@pytest.mark.parametrize('prob_cp, num_trials, marginal_tolerance', SETTINGS)
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_quota_blocks_meet_conditions(prob_cp, num_trials, marginal_tolerance, seed):
+    trials = Trials(prob_cp=prob_cp, num_trials=num_trials, marginal_tolerance=marginal_tolerance, seed=seed,
+                    method='quota')
+    assert trials.trial_data is not None
+    assert len(trials.trial_data) == num_trials
+    assert trials.attempt_number == 1
+    assert trials.check_conditions(trials.trial_data, append_marginals=False)
+
+
+@pytest.mark.parametrize('prob_cp, num_trials, marginal_tolerance', SETTINGS)
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_stream_blocks_meet_conditions(prob_cp, num_trials, marginal_tolerance, seed):
+    trials = Trials(prob_cp=prob_cp, num_trials=num_trials, marginal_tolerance=marginal_tolerance, seed=seed,
+                    method='stream')
+    assert trials.trial_data is not None
+    assert len(trials.trial_data) == num_trials
+    assert trials.check_conditions(trials.trial_data, append_marginals=False)
+
+
+@pytest.mark.parametrize('prob_cp', sorted(ALLOWED_PROB_CP))
+def test_stream_prefixes_stay_balanced(prob_cp):
+    trials = Trials(prob_cp=prob_cp, num_trials=250, generate=False)
+    probs = trials.marginal_probs()
+    counts = [dict.fromkeys(MARGINALS_TEMPLATE[v], 0) for v in TENSOR_AXES]
+    for t, trial in enumerate(trials.stream_trials(250), 1):
+        for pos, level in enumerate(trial):
+            counts[pos][level] += 1
+        for pos, level_counts in enumerate(counts):
+            deviations = np.array(list(level_counts.values())) - t * probs[pos]
+            assert np.abs(deviations).max() < 2
+
+
+def test_stream_blocks_pool_to_the_joint_distribution():
+    counts = 0
+    for seed in range(20):
+        trials = Trials(prob_cp=0.5, num_trials=250, seed=seed, generate=False)
+        counts = counts + count_tensor(materialize_trials(trials.stream_trials(250), num_trials=250))
+    probs = trials.marginal_probs()
+    joint = counts.sum(axis=(2, 3))
+    expected = joint.sum() * np.outer(probs[0], probs[1])
+    chi2 = ((joint - expected) ** 2 / expected)[expected > 0].sum()
+    # 99.9th percentile of the chi-square distribution with (3 - 1) x (4 - 1) = 6 degrees of freedom
+    assert chi2 < 22.46
+
+
+def test_stream_trials_materialize_as_a_block():
+    trials = Trials(prob_cp=0.5, num_trials=250, generate=False)
+    df = materialize_trials(trials.stream_trials(), num_trials=250)
+    assert len(df) == 250
+    assert trials.check_conditions(df, append_marginals=False)
+
+
+@pytest.mark.parametrize('method', GENERATION_METHODS)
+def test_checkpoints_are_enforced_with_every_method(method):
+    trials = Trials(prob_cp=0.8, num_trials=250, marginal_tolerance=0.05, seed=2, method=method, checkpoints=[100])
+    assert trials.trial_data is not None
+    assert trials.checkpoint_checks(trials.trial_data, trials.checkpoints).all()
+
+
+@pytest.mark.parametrize('prob_cp', sorted(ALLOWED_PROB_CP))
+@pytest.mark.parametrize('marginal_tolerance', [0.02, 0.05])
+def test_batched_check_agrees_with_dataframe_check(prob_cp, marginal_tolerance):
+    trials = Trials(prob_cp=prob_cp, num_trials=204, marginal_tolerance=marginal_tolerance, generate=False)
+    comb_codes, cp_flags = trials.draw_candidates(300, 204)
+    batched = trials.check_candidates(comb_codes, cp_flags)
+    for codes, flags, passed in zip(comb_codes, cp_flags, batched):
+        df = trials.codes_to_dataframe(codes, flags)
+        df.coh = df.coh.astype('category')
+        assert trials.check_conditions(df, append_marginals=False) == passed
+
+
+def test_rejection_block_does_not_depend_on_batch_size():
+    kwargs = dict(prob_cp=0.8, num_trials=250, marginal_tolerance=0.03, seed=4)
+    reference = Trials(batch_size=1, **kwargs)
+    for batch_size in [7, 256]:
+        trials = Trials(batch_size=batch_size, **kwargs)
+        assert trials.attempt_number == reference.attempt_number
+        assert trials.trial_data.equals(reference.trial_data)
+
+
+def test_baseline_blocks_can_be_saved_again(tmp_path):
+    filename = str(tmp_path / 'Block3.csv')
+    Trials(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, seed=3).save_to_csv(filename)
+
+    # metadata as written before spawn keys, generation methods, telemetry and npy files were introduced
+    meta_filename = str(tmp_path / 'Block3_metadata.json')
+    with open(meta_filename, 'r') as fp:
+        meta_data = json.load(fp)
+    baseline_keys = ['seed', 'num_trials', 'prob_cp', 'cond_prob_cp', 'theoretical_marginals', 'empirical_marginals',
+                     'marginal_tolerance', 'csv_filename', 'csv_md5']
+    with open(meta_filename, 'w') as fp:
+        json.dump({k: meta_data[k] for k in baseline_keys}, fp, indent=4)
+
+    loaded = Trials(from_file=filename)
+    for fmt in DATA_FORMATS:
+        copy = str(tmp_path / f'copy.{fmt}')
+        loaded.save_to_csv(copy)
+        assert np.array_equal(Trials(from_file=copy).get_count_tensor(), loaded.get_count_tensor())
+
+
+def test_sample_prob_cp_seq_is_uniform():
+    quotas = {0.2: 2, 0.5: 2, 0.8: 1}
+    valid = {seq for seq in itertools.permutations([v for v, q in quotas.items() for _ in range(q)])
+             if all(a != b for a, b in zip(seq, seq[1:]))}
+
+    rng = np.random.default_rng(np.random.SeedSequence(1))
+    num_draws = 200 * len(valid)
+    frequencies = collections.Counter(tuple(sample_prob_cp_seq(quotas, rng)) for _ in range(num_draws))
+
+    assert set(frequencies) == valid
+    expected = num_draws / len(valid)
+    chi2 = sum((f - expected) ** 2 / expected for f in frequencies.values())
+    # 99.9th percentile of the chi-square distribution with len(valid) - 1 = 11 degrees of freedom
+    assert chi2 < 31.26
+
+
+def test_sample_prob_cp_seq_rejects_impossible_quotas():
+    with pytest.raises(ValueError):
+        sample_prob_cp_seq({0.2: 3, 0.5: 1}, np.random.default_rng(1))
+
+
+def test_lazy_loading_reads_the_file_on_first_access(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'Block3.csv')
+    trials = Trials(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, seed=3)
+    trials.save_to_csv(filename)
+
+    calls = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(pd, 'read_csv', lambda *args, **kwargs: calls.append(args) or read_csv(*args, **kwargs))
+    loaded = Trials(from_file=filename, lazy=True)
+    assert loaded.prob_cp == 0.8 and not calls
+    assert len(loaded.trial_data) == 204
+    assert len(loaded.trial_data) == 204
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('fmt', DATA_FORMATS)
+def test_lazy_loading_of_a_corrupted_file_fails_on_access(tmp_path, fmt):
+    filename = str(tmp_path / f'Block3.{fmt}')
+    Trials(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, seed=3).save_to_csv(filename)
+    with open(filename, 'r+b') as fp:
+        fp.seek(-2, os.SEEK_END)
+        last_bytes = fp.read(2)
+        fp.seek(-2, os.SEEK_END)
+        fp.write(last_bytes[::-1] if last_bytes[0] != last_bytes[1] else b'00')
+
+    loaded = Trials(from_file=filename, lazy=True)
+    with pytest.raises(AssertionError, match='MD5 check failed'):
+        loaded.trial_data
+
+
+def test_nrows_without_md5_check_gives_a_prefix(tmp_path):
+    filename = str(tmp_path / 'Block3.csv')
+    trials = Trials(prob_cp=0.8, num_trials=204, marginal_tolerance=0.05, seed=3)
+    trials.save_to_csv(filename)
+
+    full = Trials(from_file=filename).trial_data
+    prefix = Trials(from_file=filename, nrows=50, usecols=['coh', 'cp'], verify_md5=False)
+    assert prefix.num_trials == 204
+    assert list(prefix.trial_data.columns) == ['coh', 'cp']
+    assert prefix.trial_data.equals(full[['coh', 'cp']].iloc[:50])
+
+
+@pytest.mark.parametrize('fmt', DATA_FORMATS)
+def test_round_trip_is_exact(tmp_path, fmt):
+    trials = Trials(prob_cp=0.8, num_trials=250, marginal_tolerance=0.02, seed=5)
+    filename = str(tmp_path / f'Block3.{fmt}')
+    trials.save_to_csv(filename)
+
+    loaded = Trials(from_file=filename)
+    # csv files lose the dtype of the mixed coh column (0, 'th', 100), which is read back as strings
+    assert loaded.trial_data.astype(str).equals(trials.trial_data.astype(str))
+    if fmt == 'npy':
+        assert loaded.trial_data.equals(trials.trial_data)
+    assert np.array_equal(loaded.get_count_tensor(), trials.get_count_tensor())
+    assert (loaded.seed, loaded.num_trials, loaded.prob_cp) == (trials.seed, trials.num_trials, trials.prob_cp)
+
+    # saving the loaded block again gives the same bytes
+    copy = str(tmp_path / f'copy.{fmt}')
+    loaded.save_to_csv(copy)
+    with open(filename, 'rb') as original, open(copy, 'rb') as copied:
+        assert original.read() == copied.read()
+
+
+def test_csv_and_npy_blocks_share_a_directory(tmp_path):
+    trials = Trials(prob_cp=0.2, num_trials=204, marginal_tolerance=0.05, seed=6)
+    for fmt in DATA_FORMATS:
+        trials.save_to_csv(str(tmp_path / f'Block3.{fmt}'))
+    for fmt in DATA_FORMATS:
+        assert np.array_equal(Trials(from_file=str(tmp_path / f'Block3.{fmt}')).get_count_tensor(),
+                              trials.get_count_tensor())
+
+
+
+@pytest.mark.parametrize('prob_cp', sorted(ALLOWED_PROB_CP))
+def test_analytic_acceptance_matches_a_pilot_run(prob_cp):
+    trials = Trials(prob_cp=prob_cp, num_trials=204, marginal_tolerance=0.02, seed=3, generate=False)
+    plan = trials.plan(204, pilot_candidates=20000)
+    rate = plan['pilot']['acceptance_rate']
+    # within 4 standard deviations of the pilot estimate. At prob_cp=0.8, treating vd and cp as independent would
+    # give a third of the pilot rate
+    assert abs(plan['analytic_acceptance'] - rate) < 4 * np.sqrt(rate * (1 - rate) / 20000)
+
+
+def test_vd_cp_pass_probability_without_cp_trials():
+    vd_probs = [0.1, 0.1, 0.4, 0.4]
+    # without CP trials the cp constraint always passes, and only the vd constraint is left
+    assert vd_cp_pass_probability(204, vd_probs, [False, False, True, True], 0, [0, 1], 0.01) == \
+        pytest.approx(marginal_pass_probability(204, vd_probs, 0.01))
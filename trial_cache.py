@@ -0,0 +1,165 @@
+"""
+This module provides an opt-in on-disk cache of generated blocks of trials
+
+Generation is deterministic given the kwargs of Trials(), so a block only needs to be generated once. Entries are keyed
+by a hash of every generation input (including trial_gen.GENERATOR_VERSION) and stored in the compact npy format.
+
+Example usage:
+  >>>> cache = TrialCache('~/.cache/trial_gen', max_bytes=50 * 2**20)
+  >>>> trials = cache.get(prob_cp=0.8, num_trials=250, seed=3, marginal_tolerance=0.01)  # generated and stored
+  >>>> trials = cache.get(prob_cp=0.8, num_trials=250, seed=3, marginal_tolerance=0.01)  # loaded from disk
+  >>>> cache.stats
+"""
+import hashlib
+import inspect
+import json
+import os
+
+from trial_gen import GENERATOR_VERSION, MARGINALS_TEMPLATE, Trials, standard_meta_filename
+
+# kwargs of Trials() which only control loading from file, and thus cannot be passed to TrialCache.get()
+LOADING_KWARGS = {'self', 'from_file', 'lazy', 'nrows', 'usecols', 'verify_md5'}
+# kwargs of Trials() which only control reporting, and thus are left out of cache keys
+REPORTING_KWARGS = {'progress_callback'}
+# numeric kwargs of Trials(), normalized by canonical_inputs()
+FLOAT_KWARGS = {'prob_cp', 'marginal_tolerance'}
+INT_KWARGS = {'num_trials', 'seed', 'max_attempts', 'batch_size'}
+MARGINAL_KWARGS = {'coh_marginals': 'coh', 'vd_marginals': 'vd', 'dir_marginals': 'dir'}
+
+
+def generation_inputs(**kwargs):
+    """
+    full set of generation inputs for the given Trials() kwargs, with defaults filled in
+    :param kwargs: kwargs that would be passed to Trials() to generate a block
+    :return: (dict) all generation kwargs, plus the generator version
+    """
+    params = inspect.signature(Trials.__init__).parameters
+    unexpected = set(kwargs) - (set(params) - LOADING_KWARGS)
+    assert not unexpected, f'unexpected kwargs {unexpected}'
+    inputs = {name: kwargs.get(name, p.default) for name, p in params.items()
+              if name not in LOADING_KWARGS | REPORTING_KWARGS}
+    inputs['generator_version'] = GENERATOR_VERSION
+    return inputs
+
+
+def canonical_inputs(**kwargs):
+    """
+    generation inputs in a JSON-serializable form, see generation_inputs(). Numbers are cast to the types of the
+    defaults of Trials(), so that e.g. prob_cp=0 and prob_cp=0.0 give the same inputs, as they give the same blocks
+    :param kwargs: kwargs that would be passed to Trials() to generate a block
+    :return: (dict)
+    """
+    inputs = generation_inputs(**kwargs)
+    canonical = {}
+    for k, v in inputs.items():
+        if k in MARGINAL_KWARGS:
+            # marginal dicts mix int and str keys, so they are serialized as lists of (repr(key), value) pairs, in the
+            # order of the template (keys such as 100.0 are found under 100)
+            canonical[k] = [[repr(kk), float(v[kk])] for kk in MARGINALS_TEMPLATE[MARGINAL_KWARGS[k]]]
+        elif k in FLOAT_KWARGS:
+            canonical[k] = float(v)
+        elif k in INT_KWARGS:
+            canonical[k] = int(v)
+        else:
+            canonical[k] = v
+    canonical['spawn_key'] = [int(i) for i in canonical['spawn_key']]
+    if canonical['checkpoints'] is not None:
+        canonical['checkpoints'] = sorted(int(c) for c in canonical['checkpoints'])
+    return canonical
+
+
+def cache_key(**kwargs):
+    """
+    hash of every generation input of a block
+    :param kwargs: kwargs that would be passed to Trials() to generate a block
+    :return: (str) hexadecimal SHA-256 digest
+    """
+    return hashlib.sha256(json.dumps(canonical_inputs(**kwargs), sort_keys=True).encode()).hexdigest()
+
+
+class TrialCache:
+    """
+    content-addressed cache of generated blocks, stored as npy data files with their metadata files in a directory
+
+    Writes go through trial_gen.write_atomically(), and two processes writing the same entry write the same bytes (the
+    timings of the generation are left out of the metadata files of entries), so that concurrent writers are safe. Least recently used entries are evicted when the cache exceeds max_bytes or
+    max_entries; the mtime of the data file of an entry is refreshed on every hit to track usage.
+    Hit and miss counts of this object are kept in self.stats.
+    """
+    def __init__(self, directory, max_bytes=None, max_entries=None):
+        """
+        :param directory: (str) cache directory, created if needed
+        :param max_bytes: (int or None) maximum total size of the cache files
+        :param max_entries: (int or None) maximum number of cached blocks
+        """
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def data_filename(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, **kwargs):
+        """
+        returns the block generated by Trials(**kwargs), from the cache if possible. Blocks whose generation failed
+        are not cached
+        :param kwargs: kwargs passed to Trials() on a miss
+        :return: Trials object, loaded from file on a hit
+        """
+        filename = self.data_filename(cache_key(**kwargs))
+        try:
+            trials = Trials(from_file=filename)
+            os.utime(filename)
+            self.stats['hits'] += 1
+            return trials
+        except (FileNotFoundError, AssertionError):
+            # missing entry, entry evicted by another process while loading, or corrupted entry
+            pass
+
+        self.stats['misses'] += 1
+        trials = Trials(**kwargs)
+        if trials.trial_data is not None:
+            trials.save_to_csv(filename, with_timings=False)
+            self.evict()
+        return trials
+
+    def entries(self):
+        """
+        :return: list of (data filename, total size of data and metadata files, last use time) tuples
+        """
+        entries = []
+        for f in os.listdir(self.directory):
+            if f[-4:] != '.npy':
+                continue
+            filename = os.path.join(self.directory, f)
+            try:
+                stat = os.stat(filename)
+                size = stat.st_size + os.path.getsize(standard_meta_filename(filename))
+            except FileNotFoundError:
+                continue
+            entries.append((filename, size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """
+        removes least recently used entries until the cache meets its size limits
+        :return: None
+        """
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total_bytes = sum(e[1] for e in entries)
+        while entries and ((self.max_bytes is not None and total_bytes > self.max_bytes) or
+                           (self.max_entries is not None and len(entries) > self.max_entries)):
+            filename, size, _ = entries.pop(0)
+            for f in [filename, standard_meta_filename(filename)]:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass  # already evicted by another process
+            total_bytes -= size
+            self.stats['evictions'] += 1
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0
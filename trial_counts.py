@@ -1,33 +1,27 @@
 from trial_gen import *
+from block_library import BlockLibrary
 
 
 if __name__ == '__main__':
     """
     Aim is to display a data frame with the following columns:
     prob_cp, coh, cp, vd, N
-    
+
     Strategy is as follows:
     1/ loop over prob_cp values
-    2/ gather all data corresponding to this prob_cp value into single data frame
+    2/ pool the counts of the first 200 trials of all blocks with this prob_cp value, from the library index
     3/ append prob_cp column
-    4/ compute number of unique combinations in such data frame
+    4/ keep the combinations that appear in the data
     5/ go to next iteration of 1/, while appending data frames
+
+    The same file is written, for any library, by: python cli.py count Blocks003 --num-trials 200 --output <file>
     """
-    filenames = ['Blocks003/Block' + str(i) + '.csv' for i in range(2,12)]
-    meta_fnames = ['Blocks003/Block' + str(i) + '_metadata.json' for i in range(2, 12)]
+    library = BlockLibrary('Blocks003')  # only new or modified block files get read
 
     list_of_df = []
-    for pcp in ALLOWED_PROB_CP:  # step 1
-        block_dfs = []
-        files_to_visit = []
-        for f in filenames:
-            mdat = Trials.load_meta_data(f)
-            if mdat['prob_cp'] == pcp:
-                files_to_visit.append(f)
-                block_dfs.append(Trials(from_file=f).trial_data.iloc[:200])
-        df = pd.concat(block_dfs)  # step 2
-        # step 4 (makes more sense to do it here)
-        new_df = df.groupby(['coh', 'cp', 'vd']).size().reset_index(name='count')
+    for pcp in sorted(ALLOWED_PROB_CP):  # step 1, in the order of cli.py count
+        new_df = library.count_conditions(['coh', 'cp', 'vd'], prob_cp=pcp, num_trials=200)  # step 2
+        new_df = new_df[new_df['count'] > 0].copy()  # step 4
         new_df['prob_cp'] = pcp  # step 3
         list_of_df.append(new_df)
 
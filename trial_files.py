@@ -0,0 +1,156 @@
+"""
+This module holds the helpers of trial_gen.py which deal with block files and their metadata, and only need the
+standard library, so that tools which only read metadata start fast, without importing numpy and pandas. They are
+re-exported by trial_gen.py
+"""
+import hashlib
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+"""
+block data files are either csv files (as read by the MATLAB task) or npy files, storing integer codes of shape
+(len(TENSOR_AXES), num_trials) whose labels are listed in the 'label_codes' entry of the metadata, see
+trial_gen.encode_trial_codes()
+"""
+DATA_FORMATS = ('csv', 'npy')
+
+
+def check_extension(f, extension):
+    """
+    check that filename has the given extension
+    :param f: (str) filename
+    :param extension: (str) extension with or without the dot. So 'csv', '.csv', 'json', '.json' are all valid
+    :return: asserts that string ends with proper extension
+    """
+    if extension[0] == '.':
+        full_extension = extension
+    else:
+        full_extension = '.' + extension
+
+    assert f[-len(extension):] == extension, f'data filename {f} does not have a {full_extension} extension'
+
+
+def data_format(filename):
+    """
+    format of a block data file, given by its extension
+    :param filename: (str) path to data file
+    :return: (str) one of DATA_FORMATS, asserts that filename has one of these extensions
+    """
+    for fmt in DATA_FORMATS:
+        if filename[-len(fmt) - 1:] == '.' + fmt:
+            return fmt
+    raise AssertionError(f'data filename {filename} has none of the extensions {DATA_FORMATS}')
+
+
+def standard_meta_filename(filename):
+    """
+    utility to quickly define the filename for the metadata, given the filename for the data. Csv blocks keep the
+    name read by the MATLAB task, e.g. Block3_metadata.json, while other formats include theirs, e.g.
+    Block3_npy_metadata.json, so that Block3.csv and Block3.npy may sit in the same directory
+    :param filename: (str) path to data file, with an extension from DATA_FORMATS
+    :return: (str) path to metadata file
+    """
+    fmt = data_format(filename)
+    suffix = '_metadata.json' if fmt == 'csv' else f'_{fmt}_metadata.json'
+    return filename[:-len(fmt) - 1] + suffix
+
+
+def md5(fname):
+    """
+    function taken from here
+    https://stackoverflow.com/a/3431838
+    :param fname: filename
+    :return: string of hexadecimal number
+    """
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+@contextmanager
+def atomic_path(filename):
+    """
+    context manager yielding a temporary path in the same directory as filename. Whatever gets written to the
+    temporary path replaces filename in a single os.replace() when the block exits without error, so that readers
+    never see a partially written file
+    :param filename: (str) final path
+    :return: (str) temporary path
+    """
+    directory, base = os.path.split(os.path.abspath(filename))
+    tmp_filename = os.path.join(directory, f'.{base}.{uuid.uuid4().hex}.tmp')
+    # unlike tempfile.mkstemp(), which creates private files, the kernel applies the umask to the mode given here.
+    # Reading the umask instead would mean setting it, for the whole process
+    os.close(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    try:
+        yield tmp_filename
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def write_atomically(filename, data):
+    """
+    writes bytes to a file through atomic_path()
+    :param filename: (str) path to file
+    :param data: (bytes) full content of the file
+    :return: None
+    """
+    with atomic_path(filename) as tmp_filename:
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(data)
+
+
+def load_meta_data(filename):
+    """
+    load metadata about trials from file
+    :param filename: (str) filename of either the trials data in one of DATA_FORMATS or its corresponding metadata
+                     in json format. If a data filename is provided, standard_meta_filename() is invoked
+    :return: (dict) metadata
+    """
+    try:
+        meta_filename = standard_meta_filename(filename)
+    except AssertionError:
+        try:
+            check_extension(filename, 'json')
+            meta_filename = filename
+        except AssertionError:
+            print(f'file {filename} has neither a data file extension nor .json extension')
+            raise ValueError
+
+    with open(meta_filename, 'r') as fp:
+        meta_data = json.load(fp)
+    return meta_data
+
+
+def md5check_from_metadata(csv_filename, meta_filename=None, meta_data=None, csv_bytes=None):
+    """
+    checks whether the data in the csv file corresponds to the MD5 checksum stored in the metadata file
+    :param csv_filename: (str)
+    :param meta_filename: (str)
+    :param meta_data: (dict or None) already parsed metadata. If None, it is loaded from meta_filename
+    :param csv_bytes: (bytes or None) already read content of the csv file. If None, the file is read
+    :return: simply asserts equality of checksums
+    """
+    if meta_data is None:
+        if meta_filename is None:
+            meta_filename = standard_meta_filename(csv_filename)
+        meta_data = load_meta_data(meta_filename)
+    csv_md5 = md5(csv_filename) if csv_bytes is None else hashlib.md5(csv_bytes).hexdigest()
+    assert meta_data['csv_md5'] == csv_md5, 'MD5 check failed!'
+    print('MD5 verified!')
+
+
+def block_filenames(directory):
+    """
+    data files of a directory (in any of DATA_FORMATS) which have a metadata file
+    :param directory: (str)
+    :return: sorted list of file names, relative to directory
+    """
+    return sorted(f for f in os.listdir(directory)
+                  if os.path.splitext(f)[1][1:] in DATA_FORMATS
+                  and os.path.exists(os.path.join(directory, standard_meta_filename(f))))
@@ -7,59 +7,48 @@ Example usage:
   >>>> trials.attempt_number
   >>>> trials.save_to_csv('/foo/bar.csv')  # a .json file gets created for meta data
   >>>> reloaded_trials = Trials(from_file='/foo/bar.csv')  # also loads meta data from .json file
+  >>>> balanced = Trials(prob_cp=0.5, num_trials=250, method='stream', checkpoints=[200])  # first 200 trials balanced
+
+Seeding:
+  Each Trials object owns a numpy.random.Generator built from numpy.random.SeedSequence(seed, spawn_key=spawn_key),
+  so that objects can be generated concurrently and independently of any other numpy randomness.
+  A set of blocks derives all its seeds from a single root seed: block i uses seed=root_seed and spawn_key=(i,),
+  which is exactly the i-th child of numpy.random.SeedSequence(root_seed).spawn(). block_seed_kwargs() returns
+  these kwargs, and both values are stored in the metadata file so that any block can be regenerated on its own.
+  >>>> blocks = [Trials(prob_cp=0.8, **kw) for kw in block_seed_kwargs(root_seed=7, num_blocks=3)]
 """
 import numpy as np
 import pandas as pd
 import json
 import hashlib
+import io
+import itertools
+import mmap
+import time
+
+# re-exported, these helpers used to live in this module
+from trial_files import DATA_FORMATS, atomic_path, check_extension, data_format, load_meta_data, md5, \
+    md5check_from_metadata, standard_meta_filename, write_atomically
 
 ALLOWED_PROB_CP = {0, 0.2, 0.5, 0.8}  # overall probability of a change-point trial
 CP_TIME = 200  # in msec
+GENERATION_METHODS = ('rejection', 'quota', 'stream')
+GENERATOR_VERSION = 2  # to increment whenever a change alters the blocks generated from the same Trials() kwargs
 MARGINALS_TEMPLATE = {
     'coh': {0: 0, 'th': 0, 100: 0},
     'vd': {100: 0, 200: 0, 300: 0, 400: 0},
     'dir': {'left': 0, 'right': 0},
     'cp': {True: 0, False: 0}
 }
-
-
-def check_extension(f, extension):
-    """
-    check that filename has the given extension
-    :param f: (str) filename
-    :param extension: (str) extension with or without the dot. So 'csv', '.csv', 'json', '.json' are all valid
-    :return: asserts that string ends with proper extension
-    """
-    if extension[0] == '.':
-        full_extension = extension
-    else:
-        full_extension = '.' + extension
-
-    assert f[-len(extension):] == extension, f'data filename {f} does not have a {full_extension} extension'
-
-
-def standard_meta_filename(filename):
-    """
-    utility to quickly define the filename for the metadata, given the filename for the data
-    :param filename: (str) path to data file
-    :return: (str) path to metadata file
-    """
-    check_extension(filename, 'csv')
-    return filename[:-4] + '_metadata.json'
-
-
-def md5(fname):
-    """
-    function taken from here
-    https://stackoverflow.com/a/3431838
-    :param fname: filename
-    :return: string of hexadecimal number
-    """
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+TENSOR_AXES = ('coh', 'vd', 'dir', 'cp')  # axes of count tensors, see count_tensor()
+TENSOR_SHAPE = tuple(len(MARGINALS_TEMPLATE[k]) for k in TENSOR_AXES)
+CONSTRAINTS = ('cohvd_pairs',) + TENSOR_AXES  # conditions checked by Trials.check_conditions()
+TELEMETRY_TIMES = ('draw_time', 'check_time', 'dataframe_time', 'total_time')  # wall-clock keys of new_telemetry()
+PREFLIGHT_MIN_SUCCESS = 0.5  # min probability of success within max_attempts for a preflight check to pass
+# metadata fields added after the first block libraries were written, with the values given to blocks without them
+LEGACY_METADATA_DEFAULTS = {'spawn_key': [], 'method': 'rejection', 'checkpoints': None, 'attempt_number': None,
+                            'generation_telemetry': None, 'data_format': 'csv'}
+PILOT_MIN_ACCEPTED = 10  # min number of accepted candidates for the pilot acceptance rate to be trusted
 
 
 def validate_marginal_keys(marg_type, marg_dict):
@@ -93,31 +82,499 @@ def validate_marginal(marg_type, marg_dict):
     validate_marginal_values(marg_dict)
 
 
-def get_marginals(df):
+def largest_remainder_round(expected, total, capacity=None):
     """
-    computes marginal distributions of all independent variables
-    :param df: dataframe of trials as returned by self.get_n_trials()
-    :return: dict with same format than MARGINALS_TEMPLATE, but empirical probs as values
+    rounds non-negative expected counts to integers summing to total, with the largest remainder rule: each entry
+    first gets the floor of its expected count, then the units left over go to the entries with the largest
+    fractional parts, ties being broken by position
+    :param expected: (1D array) expected counts
+    :param total: (int) required sum of the rounded counts
+    :param capacity: (1D array or None) optional upper bound on each rounded count. If provided, its sum should
+                     be at least total
+    :return: (1D numpy.ndarray of int)
     """
-    emp_marginals = {
-        'coh': {0: 0, 'th': 0, 100: 0},
-        'vd': {100: 0, 200: 0, 300: 0, 400: 0},
-        'dir': {'left': 0, 'right': 0},
-        'cp': {True: 0, False: 0}}
+    expected = np.asarray(expected, dtype=float)
+    if capacity is None:
+        capacity = np.full(len(expected), total)
+    counts = np.minimum(np.floor(expected).astype(int), capacity)
+
+    leftover = total - counts.sum()
+    for idx in np.argsort(counts - expected, kind='stable'):
+        if leftover == 0:
+            break
+        if counts[idx] < capacity[idx]:
+            counts[idx] += 1
+            leftover -= 1
+
+    # when capacities prevented the usual rule, remaining units go wherever there is room
+    for idx in range(len(counts)):
+        extra = min(leftover, capacity[idx] - counts[idx])
+        counts[idx] += extra
+        leftover -= extra
+
+    assert leftover == 0, 'capacities are too small for the requested total'
+    return counts
 
-    assert set(emp_marginals.keys()) == set(MARGINALS_TEMPLATE.keys())
 
-    tot_trials = len(df)
+def allocate_table(expected, row_totals, col_totals):
+    """
+    builds an integer table with exact row and column totals, close to a table of expected counts. Rows are filled
+    one at a time with largest_remainder_round(), within the room left in each column, and the last row receives
+    whatever remains
+    :param expected: (2D array) expected counts, whose rows sum to row_totals
+    :param row_totals: (1D array of int)
+    :param col_totals: (1D array of int) should have the same sum as row_totals
+    :return: (2D numpy.ndarray of int)
+    """
+    assert sum(row_totals) == sum(col_totals)
+    table = np.zeros(np.shape(expected), dtype=int)
+    room = np.array(col_totals, dtype=int)
+    for row in range(len(row_totals) - 1):
+        table[row] = largest_remainder_round(expected[row], row_totals[row], capacity=room)
+        room -= table[row]
+    table[-1] = room
+    return table
 
-    for indep_var in emp_marginals.keys():
-        for k in emp_marginals[indep_var].keys():
-            emp_marginals[indep_var][k] = len(df[df[indep_var] == k]) / tot_trials
 
+def allocate_blocks(cell_counts, cell_levels, probs, block_sizes):
+    """
+    splits pooled trial counts per cell between blocks, so that each block gets its size and stays balanced on every
+    independent variable. Blocks are filled one at a time: each cell first gets the floor of its share of the counts
+    not yet allocated, in proportion to the block size, then the units left over go one at a time to the cell whose
+    levels lag the most behind their expected counts, the fractional parts of the shares breaking ties. Expected
+    counts are cumulated over the blocks filled so far, which keeps rounding errors from piling up in the last blocks
+    :param cell_counts: (1D array of int) pooled counts per cell
+    :param cell_levels: (2D array of int) level of each cell (rows) for each independent variable (columns)
+    :param probs: (list of 1D arrays) theoretical marginal probabilities, one array per column of cell_levels
+    :param block_sizes: (list of int) should sum to the total of cell_counts
+    :return: (2D numpy.ndarray of int) table with one row per block and one column per cell
+    """
+    assert sum(block_sizes) == np.sum(cell_counts)
+    room = np.array(cell_counts, dtype=int)
+    table = np.zeros((len(block_sizes), len(room)), dtype=int)
+    cumulated = [np.zeros(len(p)) for p in probs]  # level counts of the blocks filled so far
+    num_allocated = 0
+    for block, size in enumerate(block_sizes):
+        if size == 0:
+            continue
+        share = room * size / room.sum()
+        row = np.floor(share).astype(int)
+        num_allocated += size
+        deficits = [num_allocated * p - c - np.bincount(cell_levels[:, pos], weights=row, minlength=len(p))
+                    for pos, (p, c) in enumerate(zip(probs, cumulated))]
+
+        for _ in range(size - row.sum()):
+            scores = sum(d[cell_levels[:, pos]] for pos, d in enumerate(deficits)) + share - row
+            cell = np.argmax(np.where(row < room, scores, -np.inf))
+            row[cell] += 1
+            for pos, d in enumerate(deficits):
+                d[cell_levels[cell, pos]] -= 1
+
+        table[block] = row
+        room -= row
+        for pos, p in enumerate(probs):
+            cumulated[pos] = num_allocated * p - deficits[pos]
+    return table
+
+
+def encode_trial_codes(df):
+    """
+    integer codes of the value of each independent variable, for each trial. The code of a value is its position in
+    MARGINALS_TEMPLATE[indep_var]. Column values are compared through their string representation, so that blocks
+    generated in memory and blocks reloaded from csv files (where 'coh' and 'cp' are read as strings or booleans)
+    give the same codes.
+    :param df: dataframe of trials as returned by Trials.get_n_trials() or read from a block file
+    :return: (numpy.ndarray of int8) array of shape (len(TENSOR_AXES), len(df)), rows ordered as TENSOR_AXES
+    """
+    codes = np.empty((len(TENSOR_AXES), len(df)), dtype=np.int8)
+    for row, indep_var in enumerate(TENSOR_AXES):
+        levels = [str(k) for k in MARGINALS_TEMPLATE[indep_var].keys()]
+        codes[row] = pd.Categorical(df[indep_var].astype(str), categories=levels).codes
+        assert np.all(codes[row] >= 0), f'unexpected value in column {indep_var}'
+    return codes
+
+
+def decode_trial_codes(codes, label_codes, columns=TENSOR_AXES):
+    """
+    inverse of encode_trial_codes()
+    :param codes: array of shape (len(TENSOR_AXES), num_trials), e.g. a memory-mapped view of a npy block file
+    :param label_codes: (dict) for each independent variable, the list of labels indexed by code
+    :param columns: (list) independent variables to decode
+    :return: pandas.DataFrame with the same columns and dtypes as the data frames of generated Trials objects
+    """
+    df = pd.DataFrame({indep_var: np.array(label_codes[indep_var], dtype=object)[codes[TENSOR_AXES.index(indep_var)]]
+                       for indep_var in columns})
+    for indep_var, dtype in [('vd', int), ('cp', bool)]:
+        if indep_var in columns:
+            df[indep_var] = df[indep_var].astype(dtype)
+    if 'dir' in columns:
+        df['dir'] = df['dir'].astype(str)
+    if 'coh' in columns:
+        df['coh'] = df['coh'].astype('category')
+    return df
+
+
+def map_trial_codes(filename):
+    """
+    memory-maps the integer codes stored in a npy block file
+    :param filename: (str) path to npy file
+    :return: tuple (codes, buffer) where codes is a read-only zero-copy numpy.ndarray view of the file content after
+             the npy header, and buffer is the mmap.mmap of the whole file (e.g. to compute its MD5 without copy)
+    """
+    with open(filename, 'rb') as fp:
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+        assert not fortran_order
+        offset = fp.tell()
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset), buffer
+
+
+def cell_codes(df):
+    """
+    flat index, in a count tensor, of the cell of each trial (see count_tensor() and encode_trial_codes())
+    :param df: dataframe of trials as returned by Trials.get_n_trials() or read from a block file
+    :return: (1D numpy.ndarray of int) one code per trial, in range(np.prod(TENSOR_SHAPE))
+    """
+    return np.ravel_multi_index(encode_trial_codes(df).astype(int), TENSOR_SHAPE)
+
+
+def count_tensor(df):
+    """
+    counts trials per cell of the coh x vd x dir x cp grid, in a single pass over categorical codes.
+    Tensors from several blocks may be summed to pool counts across blocks.
+    :param df: dataframe of trials as returned by Trials.get_n_trials() or read from a block file
+    :return: (numpy.ndarray of int) tensor with shape TENSOR_SHAPE and axes ordered as TENSOR_AXES
+    """
+    return codes_to_tensor(cell_codes(df))
+
+
+def codes_to_tensor(codes):
+    """
+    counts trials per cell from their cell codes, as returned by cell_codes()
+    :param codes: (1D array of int)
+    :return: (numpy.ndarray of int) tensor with shape TENSOR_SHAPE and axes ordered as TENSOR_AXES
+    """
+    return np.bincount(codes, minlength=np.prod(TENSOR_SHAPE)).reshape(TENSOR_SHAPE)
+
+
+def marginal_counts(tensors, indep_var):
+    """
+    reduces count tensors to the counts of a single independent variable
+    :param tensors: array whose last four axes follow TENSOR_AXES (a single tensor, or a stack of them)
+    :param indep_var: (str) one of TENSOR_AXES
+    :return: array of counts, with the leading axes of tensors and a last axis ordered as MARGINALS_TEMPLATE[indep_var]
+    """
+    var_axis = TENSOR_AXES.index(indep_var) - len(TENSOR_AXES)
+    return np.sum(tensors, axis=tuple(ax for ax in range(-len(TENSOR_AXES), 0) if ax != var_axis))
+
+
+def marginals_from_tensor(tensor):
+    """
+    computes marginal distributions of all independent variables from a count tensor
+    :param tensor: count tensor as returned by count_tensor()
+    :return: dict with same format than MARGINALS_TEMPLATE, but empirical probs as values
+    """
+    tot_trials = int(tensor.sum())
+    emp_marginals = {}
+    for indep_var in TENSOR_AXES:
+        counts = marginal_counts(tensor, indep_var)
+        emp_marginals[indep_var] = {k: int(c) / tot_trials for k, c in zip(MARGINALS_TEMPLATE[indep_var], counts)}
         validate_marginal(indep_var, emp_marginals[indep_var])
 
+    assert set(emp_marginals.keys()) == set(MARGINALS_TEMPLATE.keys())
     return emp_marginals
 
 
+def tensor_to_counts(tensor, ind_vars):
+    """
+    counts trials for every combination of values of the given independent variables
+    :param tensor: count tensor as returned by count_tensor(), possibly summed over several blocks
+    :param ind_vars: (list) subset of TENSOR_AXES
+    :return: pandas.DataFrame with one column per independent variable plus a 'count' column, one row per combination
+    """
+    assert set(ind_vars) <= set(TENSOR_AXES), f'independent variables should be among {TENSOR_AXES}'
+    kept_axes = [TENSOR_AXES.index(v) for v in ind_vars]
+    counts = np.sum(tensor, axis=tuple(ax for ax in range(len(TENSOR_AXES)) if ax not in kept_axes))
+    # np.sum keeps the remaining axes in TENSOR_AXES order, which may differ from the order of ind_vars
+    counts = np.transpose(counts, np.argsort(np.argsort(kept_axes)))
+
+    rows = []
+    for idx in np.ndindex(counts.shape):
+        row = {v: list(MARGINALS_TEMPLATE[v].keys())[i] for v, i in zip(ind_vars, idx)}
+        row['count'] = int(counts[idx])
+        rows.append(row)
+    return pd.DataFrame(rows, columns=list(ind_vars) + ['count'])
+
+
+def materialize_trials(trial_stream, num_trials=None):
+    """
+    collects trials yielded one at a time, e.g. by Trials.stream_trials(), into a data frame
+    :param trial_stream: iterable of (coh, vd, dir, cp) tuples
+    :param num_trials: (int or None) number of trials to collect. If None, the iterable should be finite
+    :return: pandas.DataFrame with the same columns as returned by Trials.get_n_trials(), ready for
+             Trials.save_to_csv() once attached as trial_data
+    """
+    if num_trials is not None:
+        trial_stream = itertools.islice(trial_stream, num_trials)
+    trial_df = pd.DataFrame.from_records(list(trial_stream), columns=list(TENSOR_AXES))
+    trial_df.cp = trial_df.cp.astype(bool)
+    trial_df.coh = trial_df.coh.astype('category')
+    return trial_df
+
+
+def _binomial_log_pmf(n):
+    """
+    :param n: (int) largest number of draws
+    :return: function (r, k, q) returning the log of the binomial(r, q) probability of k, with 0 * log(0) = 0
+    """
+    log_factorial = np.concatenate([[0], np.cumsum(np.log(np.arange(1, n + 1)))])
+
+    def log_pmf(r, k, q):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_q = np.where(k > 0, k * np.log(q), 0)
+            log_not_q = np.where(r - k > 0, (r - k) * np.log(1 - q), 0)
+        return log_factorial[r] - log_factorial[k] - log_factorial[r - k] + log_q + log_not_q
+    return log_pmf
+
+
+def _allowed_counts(num_trials, p, tolerance):
+    """
+    :return: (1D numpy.ndarray of int) counts out of num_trials whose proportion is within tolerance of p
+    """
+    counts = np.arange(num_trials + 1)
+    return counts[np.abs(counts / num_trials - p) <= tolerance]
+
+
+def _assign_levels(remaining, probs, remaining_prob, num_trials, tolerance, log_pmf):
+    """
+    assigns the trials left to successive levels of a multinomial, as conditional binomials, keeping the level counts
+    within tolerance of their probabilities
+    :param remaining: (1D array) probability of each number of trials left, before the levels of probs
+    :param probs: (list) probability of each level to assign
+    :param remaining_prob: (float) total probability of the levels left, including those of probs
+    :param num_trials: (int) number of trials of the block, which sets the proportions compared to tolerance
+    :param tolerance: (float) marginal tolerance
+    :param log_pmf: function returned by _binomial_log_pmf()
+    :return: (1D numpy.ndarray) probability of each number of trials left after the levels of probs, with all of
+             them within tolerance
+    """
+    for p in probs:
+        allowed = _allowed_counts(num_trials, p, tolerance)
+        q = min(p / remaining_prob, 1) if remaining_prob > 0 else 0
+        new_remaining = np.zeros(len(remaining))
+        for r in np.flatnonzero(remaining):
+            k = allowed[allowed <= r]
+            np.add.at(new_remaining, r - k, remaining[r] * np.exp(log_pmf(r, k, q)))
+        remaining = new_remaining
+        remaining_prob -= p
+    return remaining
+
+
+def marginal_pass_probability(num_trials, probs, tolerance):
+    """
+    exact probability that the empirical marginal of num_trials independent draws is within tolerance of probs, for
+    all levels at once, with the same comparison as Trials.check_conditions(). The multinomial counts are decomposed
+    into successive conditional binomials, and the probability of each number of remaining trials is propagated
+    through the allowed counts of each level
+    :param num_trials: (int)
+    :param probs: (list) theoretical probability of each level
+    :param tolerance: (float) marginal tolerance
+    :return: (float) probability
+    """
+    n = num_trials
+    remaining = np.zeros(n + 1)  # probability of each number of trials left for the following levels
+    remaining[n] = 1
+    remaining = _assign_levels(remaining, probs[:-1], 1.0, n, tolerance, _binomial_log_pmf(n))
+
+    # whatever remains goes to the last level
+    return float(remaining[_allowed_counts(n, probs[-1], tolerance)].sum())
+
+
+def vd_cp_pass_probability(num_trials, vd_probs, is_long, cond_prob_cp, cp_probs, tolerance):
+    """
+    exact probability that both the vd and the cp marginals are within tolerance. The two constraints are not
+    independent: CP trials are drawn among long trials only, so that the cp count is a binomial(cond_prob_cp)
+    thinning of the number of long trials (and a function of it when cond_prob_cp is 0 or 1). The short vd levels are
+    assigned first, so that the trials left are the long trials, whose number sets the distribution of the cp count
+    :param num_trials: (int)
+    :param vd_probs: (list) theoretical probability of each vd level
+    :param is_long: (list of bool) whether each vd level is longer than CP_TIME
+    :param cond_prob_cp: (float) probability of a CP, given that the trial is long
+    :param cp_probs: (list) theoretical probability of each cp level, the first one being the CP level
+    :param tolerance: (float) marginal tolerance
+    :return: (float) probability
+    """
+    n = num_trials
+    log_pmf = _binomial_log_pmf(n)
+    short_probs = [p for p, long in zip(vd_probs, is_long) if not long]
+    long_probs = [p for p, long in zip(vd_probs, is_long) if long]
+
+    by_long_count = np.zeros(n + 1)  # probability of each number of long trials, with short levels within tolerance
+    by_long_count[n] = 1
+    by_long_count = _assign_levels(by_long_count, short_probs, 1.0, n, tolerance, log_pmf)
+
+    cp_allowed = np.intersect1d(_allowed_counts(n, cp_probs[0], tolerance),
+                                n - _allowed_counts(n, cp_probs[1], tolerance))
+    probability = 0.0
+    for num_long in np.flatnonzero(by_long_count):
+        remaining = np.zeros(n + 1)
+        remaining[num_long] = 1
+        remaining = _assign_levels(remaining, long_probs[:-1], sum(long_probs), n, tolerance, log_pmf)
+        long_pass = remaining[_allowed_counts(n, long_probs[-1], tolerance)].sum()
+        k = cp_allowed[cp_allowed <= num_long]
+        cp_pass = np.exp(log_pmf(num_long, k, cond_prob_cp)).sum()
+        probability += by_long_count[num_long] * long_pass * cp_pass
+    return float(probability)
+
+
+def new_telemetry():
+    """
+    empty telemetry of a generation, filled by Trials.__init__() and stored in the metadata file. The TELEMETRY_TIMES
+    vary from run to run, and may be left out of the file, see Trials.save_to_csv(). Keys are
+        attempts: number of candidates counted as attempts (same as Trials.attempt_number)
+        batches: number of batches of candidates drawn
+        candidates_drawn: number of candidates drawn, including those of the last batch after the accepted one
+        rejections: for each of CONSTRAINTS, number of attempts failing it (an attempt may fail several constraints)
+        checkpoint_rejections: number of attempts meeting the conditions over the whole block but not at the
+                               checkpoints, see Trials.candidate_checkpoint_checks()
+        first_rejections: for each of CONSTRAINTS, number of attempts for which it is the first failed constraint,
+                          in the order of CONSTRAINTS
+        worst_deviation: for each independent variable, largest deviation between empirical and theoretical
+                         marginal probabilities over all attempts
+        draw_time, check_time, dataframe_time, total_time: time in seconds spent drawing candidates, checking them,
+                                                           building and checking the data frame of the accepted
+                                                           candidate, and in the whole generation
+    :return: (dict)
+    """
+    return {
+        'attempts': 0,
+        'batches': 0,
+        'candidates_drawn': 0,
+        'rejections': dict.fromkeys(CONSTRAINTS, 0),
+        'first_rejections': dict.fromkeys(CONSTRAINTS, 0),
+        'checkpoint_rejections': 0,
+        'worst_deviation': dict.fromkeys(TENSOR_AXES, 0.0),
+        'draw_time': 0.0,
+        'check_time': 0.0,
+        'dataframe_time': 0.0,
+        'total_time': 0.0
+    }
+
+
+def print_plan(plan):
+    """
+    prints a readable summary of a plan returned by Trials.plan()
+    :param plan: (dict)
+    :return: None
+    """
+    print(f"plan for {plan['num_trials']} trials with marginal tolerance {plan['marginal_tolerance']}:")
+    for v, p in plan['marginal_pass_probability'].items():
+        print(f'  P({v} marginal within tolerance) = {p:.4g}')
+    if plan['pilot'] is not None:
+        print(f"  pilot: {plan['pilot']['acceptance_rate']:.4g} acceptance over {plan['pilot']['candidates']} "
+              f"candidates, pass rates {', '.join(f'{c}: {r:.3g}' for c, r in plan['pilot']['pass_rate'].items())}")
+    print(f"  acceptance probability {plan['acceptance_probability']:.4g}, "
+          f"expected attempts {plan['expected_attempts']:.4g}, "
+          f"success probability within {plan['max_attempts']} attempts {plan['success_probability']:.4g}")
+    if plan['expected_time'] is not None:
+        print(f"  expected time {plan['expected_time']:.4g} s")
+    print(f"  binding constraint: {plan['binding_constraint']}")
+    for setting, value in plan['suggestions'].items():
+        print(f'  suggestion: {setting}={value:.4g}')
+
+
+def block_seed_kwargs(root_seed, num_blocks):
+    """
+    seeding kwargs for each block of a set, all derived from a single root seed (see module docstring)
+    :param root_seed: (int) root seed of the block set
+    :param num_blocks: (int) number of blocks in the set
+    :return: list of dicts with keys 'seed' and 'spawn_key', to be passed to Trials()
+    """
+    assert isinstance(root_seed, int)
+    children = np.random.SeedSequence(root_seed).spawn(num_blocks)
+    return [{'seed': root_seed, 'spawn_key': child.spawn_key} for child in children]
+
+
+def _count_prob_cp_seqs(quotas, last, cache):
+    """
+    number of sequences that use each value index exactly quotas[i] times and never repeat a value twice in a row
+    :param quotas: (tuple of int) remaining number of blocks per value index
+    :param last: (int) index of the previous value in the sequence, or -1 at the start
+    :param cache: (dict) memoization of previous calls, keyed by (quotas, last)
+    :return: (int) exact number of valid sequences
+    """
+    if sum(quotas) == 0:
+        return 1
+    if (quotas, last) not in cache:
+        cache[quotas, last] = sum(
+            _count_prob_cp_seqs(quotas[:i] + (q - 1,) + quotas[i + 1:], i, cache)
+            for i, q in enumerate(quotas) if q > 0 and i != last)
+    return cache[quotas, last]
+
+
+def _uniform_int_below(rng, total):
+    """
+    draws an integer uniformly in range(total), for arbitrarily large Python integers
+    :param rng: numpy.random.Generator
+    :param total: (int) positive integer
+    :return: (int)
+    """
+    num_bits = total.bit_length()
+    num_bytes = (num_bits + 7) // 8
+    while True:
+        draw = int.from_bytes(rng.bytes(num_bytes), 'little') >> (8 * num_bytes - num_bits)
+        if draw < total:
+            return draw
+
+
+def sample_prob_cp_seq(quotas, rng):
+    """
+    draws a sequence of prob_cp values to assign to successive blocks, uniformly among all the sequences where each
+    value appears exactly as many times as requested and no value appears in two consecutive blocks.
+    Sampling is done in a single pass: at each position, the next value is drawn with probability proportional to the
+    number of valid completions of the sequence, which are counted exactly by dynamic programming over the remaining
+    quota of each value
+    :param quotas: (dict) number of blocks for each prob_cp value, e.g. {0.2: 3, 0.5: 3, 0.8: 3}
+    :param rng: numpy.random.Generator
+    :return: list of prob_cp values
+    """
+    values = list(quotas.keys())
+    remaining = tuple(int(quotas[v]) for v in values)
+    assert all(q >= 0 for q in remaining)
+
+    cache = {}
+    last = -1
+    if _count_prob_cp_seqs(remaining, last, cache) == 0:
+        raise ValueError(f'no sequence without consecutive repetitions meets the quotas {quotas}')
+
+    seq = []
+    while sum(remaining) > 0:
+        # candidates and their number of valid completions, which sum to the count of the current state
+        options = [(i, _count_prob_cp_seqs(remaining[:i] + (q - 1,) + remaining[i + 1:], i, cache))
+                   for i, q in enumerate(remaining) if q > 0 and i != last]
+        draw = _uniform_int_below(rng, sum(weight for _, weight in options))
+        for last, weight in options:
+            if draw < weight:
+                break
+            draw -= weight
+        seq.append(values[last])
+        remaining = remaining[:last] + (remaining[last] - 1,) + remaining[last + 1:]
+    return seq
+
+
+def get_marginals(df):
+    """
+    computes marginal distributions of all independent variables
+    :param df: dataframe of trials as returned by self.get_n_trials()
+    :return: dict with same format than MARGINALS_TEMPLATE, but empirical probs as values
+    """
+    return marginals_from_tensor(count_tensor(df))
+
+
 class Trials:
     """
     class to create data frames of trials
@@ -128,55 +585,108 @@ class Trials:
     We list below the attributes in these two cases, as of 03 June 2019
     generated:
         attempt_number
+        checkpoints
         combinations
         cond_prob_cp
         csv_filename
         csv_md5
         empirical_marginals
+        generation_telemetry
         loaded_from_file
         marginal_tolerance
+        method
         num_trials
         prob_cp
+        rng
         seed
+        spawn_key
         theoretical_marginals
         trial_data
     loaded:
+        attempt_number
+        checkpoints
         cond_prob_cp
         csv_filename
         csv_md5
         empirical_marginals
+        generation_telemetry
         loaded_from_file
         marginal_tolerance
+        method
         num_trials
         prob_cp
         seed
+        spawn_key
         theoretical_marginals
         trial_data
     """
+    _trial_data = None
+    _trial_codes = None  # memory-mapped codes, for objects loaded from a npy file
+    _pending_load = None  # callable reading self.trial_data from file, for objects loaded lazily
+
     def __init__(self,
                  prob_cp=0,
                  num_trials=204,
                  seed=1,
+                 spawn_key=(),
                  coh_marginals={0: .4, 'th': .5, 100: .1},
                  vd_marginals={100: .1, 200: .1, 300: .4, 400: .4},
                  dir_marginals={'left': 0.5, 'right': 0.5},
                  max_attempts=10000,
                  marginal_tolerance=0.05,
-                 from_file=None):
+                 batch_size=256,
+                 method='rejection',
+                 preflight=False,
+                 generate=True,
+                 progress_callback=None,
+                 checkpoints=None,
+                 from_file=None,
+                 lazy=False,
+                 nrows=None,
+                 usecols=None,
+                 verify_md5=True):
         """
 
         :param prob_cp: theoretical proba of a CP trials over all trials
         :param num_trials: number of trials in the data attached to object
         :param seed: seed used to generate the data
+        :param spawn_key: (tuple of int) spawn key of the numpy.random.SeedSequence built from seed. Blocks of a set
+                          share the same root seed and differ by their spawn key, see block_seed_kwargs()
         :param coh_marginals: marginal probabilities for coherence values, across all trials
         :param vd_marginals: marginal probabilities for viewing duration values, across all trials
         :param dir_marginals: marginal probabilities for direction values, across all trials
         :param max_attempts: max number of iterations to do to try to generate trials with correct statistics
         :param marginal_tolerance: tolerance in the empirical marginals of the generated trials
+        :param batch_size: number of candidate blocks drawn and checked at once during the rejection loop. It only
+                           affects speed: the generated block and attempt number are those of one-at-a-time drawing
+        :param method: (str) one of GENERATION_METHODS. 'rejection' draws random blocks until one meets the
+                       conditions. 'quota' allocates exact per-cell trial counts with self.quota_counts() and
+                       shuffles them, so that a single pass is needed. 'stream' draws trials one at a time with
+                       self.stream_trials(), keeping the running marginals balanced, so that any prefix of the block
+                       is balanced as well
+        :param preflight: (bool) only used with method='rejection'. If True, self.plan() is called before generation,
+                          and generation is not attempted when the probability of success within max_attempts is
+                          below PREFLIGHT_MIN_SUCCESS. The plan is printed with suggested settings in that case
+        :param generate: (bool) if False, the object is set up but no block is generated (self.trial_data is None),
+                         e.g. to call self.plan() only
+        :param progress_callback: (callable or None) only used with method='rejection'. Called after each batch of
+                                  candidates with the telemetry dict of the ongoing generation, see new_telemetry()
+        :param checkpoints: (list of int or None) prefix lengths at which the block should meet the conditions of
+                            self.check_conditions() too, e.g. [200] when only the first 200 trials of a block may be
+                            analyzed. Checked with every method, but only method='stream' balances prefixes on
+                            purpose, the other methods may fail or need many more attempts
         :param from_file: filename to load data from. If None, data is randomly generated. If a filename is provided,
-                          it should have a .csv extension and a corresponding metadata file with name equal to standard_
-                          meta_filename(filename) should exist. Note that if data and meta_data are loaded from files,
+                          it should have an extension from DATA_FORMATS and a corresponding metadata file with name
+                          equal to standard_meta_filename(filename) should exist. Note that if data and meta_data are loaded from files,
                           all other kwargs provided to __init__ will be overriden by self._load_from_file()
+        :param lazy: (bool) only used with from_file. If True, metadata attributes are set right away but the csv file
+                     is only read, verified and parsed on first access to self.trial_data
+        :param nrows: (int or None) only used with from_file. If provided, only the first nrows trials are parsed.
+                      Note that self.num_trials still refers to the full block
+        :param usecols: (list or None) only used with from_file. If provided, only these columns are parsed
+        :param verify_md5: (bool) only used with from_file. If False, the MD5 check is skipped, which allows reading
+                           only the needed part of the csv file when nrows is provided. If True, the whole file is
+                           read and verified, at construction time, or at first access to self.trial_data when lazy
         """
         if from_file is None:
             self.loaded_from_file = False
@@ -184,10 +694,18 @@ class Trials:
             assert 0 < marginal_tolerance < 1
             self.marginal_tolerance = marginal_tolerance
 
+            assert method in GENERATION_METHODS, f'method should be one of {GENERATION_METHODS}'
+            self.method = method
+
+            self.checkpoints = None if checkpoints is None else sorted(int(c) for c in checkpoints)
+            assert self.checkpoints is None or all(0 < c <= num_trials for c in self.checkpoints), \
+                'checkpoints should be within the block'
+
             # for reproducibility
             assert isinstance(seed, int)
             self.seed = seed
-            np.random.seed(self.seed)
+            self.spawn_key = tuple(spawn_key)
+            self.rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=self.spawn_key))
 
             # validate core marginals
             validate_marginal('coh', coh_marginals)
@@ -231,163 +749,711 @@ class Trials:
                     for vd_k, vd_val in self.theoretical_marginals['vd'].items():
                         self.combinations[(coh_k, vd_k, dir_k)] = coh_val * vd_val * dir_val
 
-            attempt = 0
-            assert attempt < max_attempts
-
-            try_again = True
-            while attempt < max_attempts and try_again:
-                trial_df = self.get_n_trials(num_trials)
-                attempt += 1
-
-                """
-                the following line is important because 'coh' column might be interpreted as int if no 'th' value 
-                appears, and this produces a TypeError when filtering against the string 'th'
-                """
-                trial_df.coh = trial_df.coh.astype('category')
-
-                # try again unless conditions are met
+            # integer-coded lookup tables used by the batched candidate engine (see self.draw_candidates())
+            self._build_code_tables()
+
+            telemetry = new_telemetry()
+            generation_start = time.perf_counter()
+
+            preflight_failed = False
+            if preflight and self.method == 'rejection' and generate:
+                plan = self.plan(num_trials, max_attempts)
+                preflight_failed = plan['success_probability'] < PREFLIGHT_MIN_SUCCESS
+                if preflight_failed:
+                    print_plan(plan)
+
+            if not generate or preflight_failed:
+                attempt = 0
+                trial_df = None
+                try_again = preflight_failed
+            elif self.method == 'quota':
+                # a single deterministic allocation of trials to cells, shuffled, replaces the rejection loop
+                attempt = 1
+                trial_df = self.get_quota_trials(num_trials)
                 try_again = not self.check_conditions(trial_df)
-
-            if try_again:
+                if self.checkpoints and not try_again:
+                    try_again = not self.checkpoint_checks(trial_df, self.checkpoints).all()
+            elif self.method == 'stream':
+                # a single balanced pass, which may only fail for short prefixes or tight tolerances
+                attempt = 1
+                trial_df = materialize_trials(self.stream_trials(num_trials))
+                try_again = not self.check_conditions(trial_df)
+                if self.checkpoints and not try_again:
+                    try_again = not self.checkpoint_checks(trial_df, self.checkpoints).all()
+            else:
+                attempt = 0
+                assert attempt < max_attempts
+                assert batch_size >= 1
+
+                try_again = True
+                while attempt < max_attempts and try_again:
+                    # draw a whole batch of candidate blocks at once, never more than the remaining attempts allow
+                    num_candidates = min(batch_size, max_attempts - attempt)
+                    start = time.perf_counter()
+                    comb_codes, cp_flags = self.draw_candidates(num_candidates, num_trials)
+                    drawn = time.perf_counter()
+                    tensors = self.candidate_tensors(comb_codes, cp_flags)
+                    deviations = self.marginal_deviations(tensors)
+                    checks = self.constraint_checks(tensors, deviations)
+                    block_passed = np.flatnonzero(np.logical_and.reduce(list(checks.values())))
+                    passed = block_passed[self.candidate_checkpoint_checks(comb_codes[block_passed],
+                                                                           cp_flags[block_passed])]
+                    checked = time.perf_counter()
+
+                    # attempts are counted as if candidates had been drawn one at a time
+                    num_counted = num_candidates if passed.size == 0 else passed[0] + 1
+                    attempt += num_counted
+                    self._update_telemetry(telemetry, checks, deviations, num_counted)
+                    # counted candidates which met the conditions over the whole block, but not at the checkpoints
+                    telemetry['checkpoint_rejections'] += int(np.count_nonzero(block_passed < num_counted)) - \
+                        min(passed.size, 1)
+                    telemetry['draw_time'] += drawn - start
+                    telemetry['check_time'] += checked - drawn
+
+                    if passed.size > 0:
+                        trial_df = self.codes_to_dataframe(comb_codes[passed[0]], cp_flags[passed[0]])
+
+                        """
+                        the following line is important because 'coh' column might be interpreted as int if no 'th' 
+                        value appears, and this produces a TypeError when filtering against the string 'th'
+                        """
+                        trial_df.coh = trial_df.coh.astype('category')
+
+                        # the DataFrame check also attaches the empirical marginals to the object
+                        try_again = not self.check_conditions(trial_df)
+                        assert not try_again, 'batched and DataFrame checks disagree'
+                        telemetry['dataframe_time'] += time.perf_counter() - checked
+
+                    if progress_callback is not None:
+                        progress_callback(telemetry)
+
+            if not generate:
+                self.trial_data = None
+                self.num_trials = 0
+            elif preflight_failed:
+                print('preflight check failed, trial generation was not attempted')
+                self.trial_data = None
+                self.num_trials = 0
+            elif try_again and self.method in ('quota', 'stream'):
+                print(f'the {self.method} allocation of {num_trials} trials does not meet the conditions\n'
+                      f'trial generation failed. You may increase num_trials, marginal_tolerance or the checkpoints')
+                self.trial_data = None  # generation failed
+                self.num_trials = 0
+            elif try_again:
                 print(f'after {attempt} attempts, no trial set met the conditions\n'
-                      f'trial generation failed. You may try again with another seed,\n'
-                      f'or increase the max_attempts argument')
+                      f'trial generation failed. You may try again with another seed (see seed_registry.py\n'
+                      f'to search seeds in parallel), or increase the max_attempts argument')
                 self.trial_data = None  # generation failed
                 self.num_trials = 0
             else:
                 self.trial_data = trial_df
                 self.num_trials = len(trial_df)
 
-            self.attempt_number = attempt
+            self.attempt_number = int(attempt)
+            telemetry['attempts'] = self.attempt_number
+            telemetry['total_time'] = time.perf_counter() - generation_start
+            self.generation_telemetry = telemetry
             self.csv_md5 = None
             self.csv_filename = None
         else:
-            self._load_from_file(from_file)
+            self._load_from_file(from_file, lazy=lazy, nrows=nrows, usecols=usecols, verify_md5=verify_md5)
 
-    @staticmethod
-    def load_meta_data(filename):
-        """
-        load metadata about trials from file
-        :param filename: (str) filename of either the trials data in csv format or its corresponding metadata in json
-                         format. If filename with .csv extension is provided, standard_meta_filename() is invoked
-        :return: (dict) metadata
-        """
-        try:
-            check_extension(filename, 'csv')
-            meta_filename = standard_meta_filename(filename)
-        except AssertionError:
-            try:
-                check_extension(filename, 'json')
-                meta_filename = filename
-            except AssertionError:
-                print(f'file {filename} has neither .csv nor .json extension')
-                raise ValueError
-
-        with open(meta_filename, 'r') as fp:
-            meta_data = json.load(fp)
-        return meta_data
-
-    @staticmethod
-    def md5check_from_metadata(csv_filename, meta_filename=None):
-        """
-        checks whether the data in the csv file corresponds to the MD5 checksum stored in the metadata file
-        :param csv_filename: (str)
-        :param meta_filename: (str)
-        :return: simply asserts equality of checksums
-        """
-        if meta_filename is None:
-            meta_filename = standard_meta_filename(csv_filename)
-        assert Trials.load_meta_data(meta_filename)['csv_md5'] == md5(csv_filename), 'MD5 check failed!'
-        print('MD5 verified!')
+    # the metadata helpers only need the standard library, see trial_files.py
+    load_meta_data = staticmethod(load_meta_data)
+    md5check_from_metadata = staticmethod(md5check_from_metadata)
 
-    def _load_from_file(self, fname, meta_file=None):
+    def _load_from_file(self, fname, meta_file=None, lazy=False, nrows=None, usecols=None, verify_md5=True):
         """
-        load full object from .csv file and its corresponding metadata file
-        :param fname: (str) path to csv file
+        load full object from .csv (or .npy) file and its corresponding metadata file
+        :param fname: (str) path to data file, with an extension from DATA_FORMATS
         :param meta_file: (str or None) either path to metadatafile or None (default).
                           If None, standard_meta_filename() is called
+        :param lazy: (bool) if True, reading the csv file is postponed until first access to self.trial_data
+        :param nrows: (int or None) number of trials to parse, all of them if None
+        :param usecols: (list or None) columns to parse, all of them if None
+        :param verify_md5: (bool) whether to check the csv file against the MD5 checksum from the metadata
         :return: sets many attributes
         """
         if meta_file is None:
             meta_file = standard_meta_filename(fname)
-        Trials.md5check_from_metadata(fname, meta_filename=meta_file)
         meta_data = Trials.load_meta_data(meta_file)
 
-        # load data into pandas.DataFrame and attach it as attribute
-        self.trial_data = pd.read_csv(fname)
+        def read_trial_data():
+            if not verify_md5:
+                return pd.read_csv(fname, nrows=nrows, usecols=usecols)
+
+            # the file is read once, and the same bytes are both verified and parsed
+            with open(fname, 'rb') as fp:
+                csv_bytes = fp.read()
+            Trials.md5check_from_metadata(fname, meta_data=meta_data, csv_bytes=csv_bytes)
+            return pd.read_csv(io.BytesIO(csv_bytes), nrows=nrows, usecols=usecols)
+
+        if data_format(fname) == 'npy':
+            # mapping the file does not read it. The mapped bytes are hashed when trial_data is decoded
+            codes, buffer = map_trial_codes(fname)
+            self._trial_codes = codes[:, :nrows]
+
+            def read_trial_data():
+                if verify_md5:
+                    Trials.md5check_from_metadata(fname, meta_data=meta_data, csv_bytes=buffer)
+                columns = TENSOR_AXES if usecols is None else [c for c in TENSOR_AXES if c in usecols]
+                return decode_trial_codes(self._trial_codes, meta_data['label_codes'], columns)
+
+        # load data into pandas.DataFrame and attach it as attribute, now or on first access
+        if lazy:
+            self._trial_data = None
+            self._pending_load = read_trial_data
+        else:
+            self.trial_data = read_trial_data()
 
         # set key-value pairs from metadata as attributes
-        for k, v in meta_data.items():
+        for k, v in dict(LEGACY_METADATA_DEFAULTS, **meta_data).items():
             setattr(self, k, v)
 
         self.loaded_from_file = True
 
-    def get_n_trials(self, n):
-        rows = []  # will be a list of dicts, where each dict is a pandas.DataFrame row
-        for trial in range(n):
-            comb_keys = list(self.combinations.keys())
-            comb_number = np.random.choice(len(comb_keys), p=list(self.combinations.values()))
-            comb = comb_keys[comb_number]
+    @classmethod
+    def from_bytes(cls, data_bytes, meta_data, verify_md5=True):
+        """
+        builds an object from the content of a data file and its metadata, as if it were loaded from file, e.g. for
+        blocks stored in a library archive (see library_archive.py)
+        :param data_bytes: (bytes) content of a csv or npy data file
+        :param meta_data: (dict) content of the metadata file
+        :param verify_md5: (bool) whether to check data_bytes against the MD5 checksum from the metadata
+        :return: Trials object
+        """
+        trials = cls.__new__(cls)
+        if verify_md5:
+            Trials.md5check_from_metadata(meta_data['csv_filename'], meta_data=meta_data, csv_bytes=data_bytes)
+        if meta_data.get('data_format', 'csv') == 'npy':
+            codes = np.load(io.BytesIO(data_bytes), allow_pickle=False)
+            trials.trial_data = decode_trial_codes(codes, meta_data['label_codes'])
+        else:
+            trials.trial_data = pd.read_csv(io.BytesIO(data_bytes))
+        for k, v in dict(LEGACY_METADATA_DEFAULTS, **meta_data).items():
+            setattr(trials, k, v)
+        trials.loaded_from_file = True
+        return trials
+
+    def get_trial_codes(self):
+        """
+        integer codes of the trials, see encode_trial_codes(). For objects loaded from a npy file, this is a zero-copy
+        view of the memory-mapped file
+        :return: (numpy.ndarray) array of shape (len(TENSOR_AXES), number of trials)
+        """
+        if self._trial_codes is not None:
+            return self._trial_codes
+        return encode_trial_codes(self.trial_data)
+
+    @property
+    def trial_data(self):
+        """
+        pandas.DataFrame of trials, or None if generation failed. For objects loaded lazily from file, the csv file is
+        read on first access
+        """
+        if self._pending_load is not None:
+            self._trial_data = self._pending_load()
+            self._pending_load = None
+        return self._trial_data
+
+    @trial_data.setter
+    def trial_data(self, value):
+        self._trial_data = value
+        self._pending_load = None
+
+    def _build_code_tables(self):
+        """
+        builds the lookup tables that map integer combination codes (indices into list(self.combinations.keys()))
+        to the levels of each independent variable
+        :return: sets private attributes used by self.draw_candidates() and self.check_candidates()
+        """
+        self._comb_keys = list(self.combinations.keys())
+        self._comb_cdf = np.cumsum(list(self.combinations.values()))
+
+        # label arrays, indexed by combination code
+        self._comb_labels = {
+            'coh': np.array([comb[0] for comb in self._comb_keys], dtype=object),
+            'vd': np.array([comb[1] for comb in self._comb_keys]),
+            'dir': np.array([comb[2] for comb in self._comb_keys], dtype=object)
+        }
+        self._comb_is_long = self._comb_labels['vd'] > CP_TIME
+
+        # flat index of each combination in a count tensor, for non-CP trials (see count_tensor())
+        level_idxs = [[list(MARGINALS_TEMPLATE[v].keys()).index(comb[pos]) for comb in self._comb_keys]
+                      for pos, v in enumerate(['coh', 'vd', 'dir'])]
+        cp_false_idx = list(MARGINALS_TEMPLATE['cp'].keys()).index(False)
+        cp_true_idx = list(MARGINALS_TEMPLATE['cp'].keys()).index(True)
+        self._comb_cells = np.ravel_multi_index(level_idxs + [[cp_false_idx] * len(self._comb_keys)], TENSOR_SHAPE)
+        self._cp_cell_shift = cp_true_idx - cp_false_idx  # shift of the flat index for CP trials
+
+    def draw_candidates(self, num_candidates, n, rng=None):
+        """
+        draws several candidate blocks of trials at once, in integer-coded form
+        :param num_candidates: (int) number of candidate blocks K
+        :param n: (int) number of trials per block
+        :param rng: (numpy.random.Generator or None) generator to draw from, self.rng if None
+        :return: tuple (comb_codes, cp_flags) of (K x n) arrays. comb_codes are indices into
+                 list(self.combinations.keys()) and cp_flags are booleans
+        """
+        if rng is None:
+            rng = self.rng
+
+        # a single call provides the uniform draws for both the combinations and the CP coin flips. Candidates come
+        # first in the shape, so that candidate i always uses the same slice of the stream, whatever the batch size
+        uniforms = rng.random((num_candidates, 2, n))
+
+        comb_codes = np.searchsorted(self._comb_cdf, uniforms[:, 0], side='right')
+        # guards against the last cumulative probability being slightly under 1 because of rounding
+        np.minimum(comb_codes, len(self._comb_keys) - 1, out=comb_codes)
+
+        # this is a CP trial only if VD > 200 and biased coin flip turns out HEADS
+        cp_flags = self._comb_is_long[comb_codes] & (uniforms[:, 1] < self.cond_prob_cp)
+        return comb_codes, cp_flags
+
+    def check_candidates(self, comb_codes, cp_flags):
+        """
+        vectorized version of self.check_conditions() over integer-coded candidate blocks
+        :param comb_codes: (K x n) array of combination codes, as returned by self.draw_candidates()
+        :param cp_flags: (K x n) boolean array, as returned by self.draw_candidates()
+        :return: (K,) boolean array, True for candidates that meet the conditions
+        """
+        return self.check_tensors(self.candidate_tensors(comb_codes, cp_flags))
+
+    def candidate_tensors(self, comb_codes, cp_flags):
+        """
+        builds the count tensors of integer-coded candidate blocks, in a single bincount
+        :param comb_codes: (K x n) array of combination codes, as returned by self.draw_candidates()
+        :param cp_flags: (K x n) boolean array, as returned by self.draw_candidates()
+        :return: (K x TENSOR_SHAPE) array of counts
+        """
+        num_candidates = comb_codes.shape[0]
+        num_cells = np.prod(TENSOR_SHAPE)
+
+        cells = self._comb_cells[comb_codes] + self._cp_cell_shift * cp_flags
+        offsets = num_cells * np.arange(num_candidates)[:, None]
+        flat_counts = np.bincount((cells + offsets).ravel(), minlength=num_candidates * num_cells)
+        return flat_counts.reshape((num_candidates,) + TENSOR_SHAPE)
+
+    def check_tensors(self, tensors):
+        """
+        applies the conditions described in self.check_conditions() to count tensors
+        :param tensors: (K x TENSOR_SHAPE) array of counts, one tensor per block
+        :return: (K,) boolean array, True for blocks that meet the conditions
+        """
+        return np.logical_and.reduce(list(self.constraint_checks(tensors).values()))
+
+    def marginal_deviations(self, tensors):
+        """
+        largest deviation between empirical and theoretical marginal probabilities, for each independent variable
+        :param tensors: (K x TENSOR_SHAPE) array of counts, one tensor per block
+        :return: (dict) keys are TENSOR_AXES and values are (K,) float arrays
+        """
+        n = tensors.reshape(len(tensors), -1).sum(axis=1)
+        deviations = {}
+        for indep_var in TENSOR_AXES:
+            emp = marginal_counts(tensors, indep_var) / n[:, None]
+            theo = np.array([self.theoretical_marginals[indep_var][k] for k in MARGINALS_TEMPLATE[indep_var]])
+            deviations[indep_var] = np.max(np.abs(emp - theo), axis=1)
+        return deviations
+
+    def constraint_checks(self, tensors, deviations=None):
+        """
+        outcome of each of the conditions described in self.check_conditions(), separately
+        :param tensors: (K x TENSOR_SHAPE) array of counts, one tensor per block
+        :param deviations: (dict or None) output of self.marginal_deviations(tensors), computed if None
+        :return: (dict) keys are CONSTRAINTS and values are (K,) boolean arrays, True where the constraint is met
+        """
+        if deviations is None:
+            deviations = self.marginal_deviations(tensors)
+
+        # same rule as df.duplicated(subset=['coh', 'vd'], keep=False) on the trials
+        pair_counts = tensors.sum(axis=(-2, -1))
+        num_cohvd_pairs = np.where(pair_counts > 1, pair_counts, 0).sum(axis=(-2, -1))
+        checks = {'cohvd_pairs': num_cohvd_pairs >= 5}
+
+        for indep_var in TENSOR_AXES:
+            checks[indep_var] = deviations[indep_var] <= self.marginal_tolerance
+
+        return checks
+
+    @staticmethod
+    def _update_telemetry(telemetry, checks, deviations, num_counted):
+        """
+        adds the outcome of the first num_counted candidates of a batch to the telemetry, see new_telemetry()
+        :param telemetry: (dict) updated in place
+        :param checks: (dict) as returned by self.constraint_checks()
+        :param deviations: (dict) as returned by self.marginal_deviations()
+        :param num_counted: (int) number of candidates of the batch which count as attempts
+        :return: None
+        """
+        telemetry['batches'] += 1
+        telemetry['candidates_drawn'] += len(checks['cohvd_pairs'])
+
+        failed_before = np.zeros(num_counted, dtype=bool)
+        for constraint in CONSTRAINTS:
+            failed = ~checks[constraint][:num_counted]
+            telemetry['rejections'][constraint] += int(failed.sum())
+            telemetry['first_rejections'][constraint] += int((failed & ~failed_before).sum())
+            failed_before |= failed
+
+        for indep_var in TENSOR_AXES:
+            worst = float(deviations[indep_var][:num_counted].max())
+            telemetry['worst_deviation'][indep_var] = max(telemetry['worst_deviation'][indep_var], worst)
+
+    def plan(self, num_trials, max_attempts=10000, pilot_candidates=2000, batch_size=256):
+        """
+        estimates the cost of rejection sampling for the settings of this object, before spending CPU on it.
+        The acceptance probability is estimated analytically, as the product of the exact probabilities that the coh
+        marginal, the dir marginal, and the vd and cp marginals together are within tolerance (see
+        marginal_pass_probability() and vd_cp_pass_probability()), and with a Monte Carlo pilot run of the batched engine, which uses its own random stream so that
+        self.rng is left untouched. Only the pilot run accounts for self.checkpoints. The pilot estimate is only used
+        when it accepted at least PILOT_MIN_ACCEPTED candidates, since a handful of lucky acceptances would overstate
+        the rate by orders of magnitude.
+        :param num_trials: (int) number of trials per block
+        :param max_attempts: (int) attempt budget used to compute the probability of success
+        :param pilot_candidates: (int) number of candidates of the pilot run, 0 to skip it
+        :param batch_size: (int) number of candidates drawn at once during the pilot run
+        :return: (dict) with keys
+                 'marginal_pass_probability': exact pass probability of each marginal constraint
+                 'analytic_acceptance': product of the coh, dir and joint vd x cp pass probabilities
+                 'pilot': None, or dict with the number of candidates, the pass rate of each of CONSTRAINTS, the
+                          acceptance rate and the time per candidate in seconds
+                 'acceptance_probability': best estimate of the acceptance probability of a candidate
+                 'expected_attempts', 'expected_time' (in s, None without pilot), 'success_probability' within
+                 max_attempts, 'binding_constraint': constraint with the lowest pass probability, and
+                 'suggestions': loosest-first dict with the smallest 'marginal_tolerance' and the smallest
+                 'num_trials' (other settings unchanged) which bring the analytic success probability above 0.99
+        """
+        def analytic(n, tolerance):
+            return {v: marginal_pass_probability(n, [self.theoretical_marginals[v][k] for k in MARGINALS_TEMPLATE[v]],
+                                                 tolerance)
+                    for v in TENSOR_AXES}
+
+        def analytic_acceptance_of(n, tolerance):
+            # coh and dir are independent of the other variables, vd and cp are not, see vd_cp_pass_probability()
+            probs = self.marginal_probs()
+            vd_levels = list(MARGINALS_TEMPLATE['vd'])
+            vd_cp = vd_cp_pass_probability(n, probs[TENSOR_AXES.index('vd')], [v > CP_TIME for v in vd_levels],
+                                           self.cond_prob_cp, [self.prob_cp, 1 - self.prob_cp], tolerance)
+            independent = analytic(n, tolerance)
+            return float(independent['coh'] * independent['dir'] * vd_cp)
+
+        def success(acceptance):
+            return 1 - (1 - acceptance) ** max_attempts
+
+        pass_probability = analytic(num_trials, self.marginal_tolerance)
+        analytic_acceptance = analytic_acceptance_of(num_trials, self.marginal_tolerance)
+
+        pilot = None
+        acceptance = analytic_acceptance
+        binding = min(pass_probability, key=pass_probability.get)
+        if pilot_candidates > 0:
+            rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=tuple(self.spawn_key) + (0,)))
+            num_passed = dict.fromkeys(CONSTRAINTS, 0)
+            num_accepted = 0
+            start = time.perf_counter()
+            for first in range(0, pilot_candidates, batch_size):
+                num_candidates = min(batch_size, pilot_candidates - first)
+                comb_codes, cp_flags = self.draw_candidates(num_candidates, num_trials, rng=rng)
+                checks = self.constraint_checks(self.candidate_tensors(comb_codes, cp_flags))
+                for constraint, passed in checks.items():
+                    num_passed[constraint] += int(passed.sum())
+                accepted = np.flatnonzero(np.logical_and.reduce(list(checks.values())))
+                num_accepted += int(self.candidate_checkpoint_checks(comb_codes[accepted], cp_flags[accepted]).sum())
+            pilot = {
+                'candidates': pilot_candidates,
+                'pass_rate': {c: num_passed[c] / pilot_candidates for c in CONSTRAINTS},
+                'acceptance_rate': num_accepted / pilot_candidates,
+                'time_per_candidate': (time.perf_counter() - start) / pilot_candidates
+            }
+            if num_accepted >= PILOT_MIN_ACCEPTED:
+                acceptance = pilot['acceptance_rate']
+                binding = min(pilot['pass_rate'], key=pilot['pass_rate'].get)
+
+        expected_attempts = 1 / acceptance if acceptance > 0 else float('inf')
+        suggestions = {}
+        if success(acceptance) < 0.99:
+            for factor in [1.25, 1.5, 2, 2.5, 3, 4, 5]:
+                tolerance = self.marginal_tolerance * factor
+                if tolerance < 1 and success(analytic_acceptance_of(num_trials, tolerance)) >= 0.99:
+                    suggestions['marginal_tolerance'] = tolerance
+                    break
+            for factor in [1.25, 1.5, 2, 2.5, 3, 4, 5]:
+                n = int(np.ceil(num_trials * factor))
+                if success(analytic_acceptance_of(n, self.marginal_tolerance)) >= 0.99:
+                    suggestions['num_trials'] = n
+                    break
+
+        return {
+            'num_trials': num_trials,
+            'marginal_tolerance': self.marginal_tolerance,
+            'max_attempts': max_attempts,
+            'marginal_pass_probability': pass_probability,
+            'analytic_acceptance': analytic_acceptance,
+            'pilot': pilot,
+            'acceptance_probability': acceptance,
+            'expected_attempts': expected_attempts,
+            'expected_time': None if pilot is None else expected_attempts * pilot['time_per_candidate'],
+            'success_probability': success(acceptance),
+            'binding_constraint': binding,
+            'suggestions': suggestions
+        }
+
+    def codes_to_dataframe(self, comb_codes, cp_flags):
+        """
+        converts a single integer-coded block into a data frame of trials
+        :param comb_codes: (n,) array of combination codes
+        :param cp_flags: (n,) boolean array
+        :return: pandas.DataFrame with the same columns as returned by self.get_n_trials()
+        """
+        return pd.DataFrame({'coh': self._comb_labels['coh'][comb_codes],
+                             'vd': self._comb_labels['vd'][comb_codes],
+                             'dir': self._comb_labels['dir'][comb_codes],
+                             'cp': np.asarray(cp_flags, dtype=bool)})
+
+    def quota_counts(self, n):
+        """
+        turns the joint probabilities of self.combinations and self.cond_prob_cp into exact trial counts per cell,
+        where a cell is a combination together with a CP flag. The rounding rule is deterministic: the coh, vd and
+        dir marginal counts are first obtained with largest_remainder_round(), then the joint table is filled one
+        independent variable at a time with allocate_table(), so that every empirical marginal ends up within one
+        trial of its theoretical count. CP trials are finally spread over the long-trial cells in the same way.
+        :param n: (int) number of trials to allocate
+        :return: tuple (comb_codes, cp_flags, counts) of 1D arrays of equal length, one entry per cell
+        """
+        probs = {k: np.array(list(self.theoretical_marginals[k].values())) for k in ['coh', 'vd', 'dir']}
+        levels = {k: list(self.theoretical_marginals[k].keys()) for k in ['coh', 'vd', 'dir']}
+        margin_counts = {k: largest_remainder_round(n * p, n) for k, p in probs.items()}
+
+        # Coh-VD table, then (Coh-VD pair) x dir table
+        coh_vd = allocate_table(margin_counts['coh'][:, None] * probs['vd'], margin_counts['coh'], margin_counts['vd'])
+        coh_vd = coh_vd.ravel()
+        coh_vd_dir = allocate_table(coh_vd[:, None] * probs['dir'], coh_vd, margin_counts['dir']).ravel()
+
+        # cells in the order of np.ndindex over (coh, vd, dir), mapped to combination codes
+        cell_combs = [(levels['coh'][i], levels['vd'][j], levels['dir'][k])
+                      for i, j, k in np.ndindex(len(levels['coh']), len(levels['vd']), len(levels['dir']))]
+        comb_codes = np.array([self._comb_keys.index(comb) for comb in cell_combs])
+
+        # split the long-trial cells into CP and non-CP trials
+        is_long = self._comb_is_long[comb_codes]
+        num_long = coh_vd_dir[is_long].sum()
+        num_cp = min(largest_remainder_round(n * np.array([self.prob_cp, 1 - self.prob_cp]), n)[0], num_long)
+        cp_split = allocate_table(coh_vd_dir[is_long][:, None] * np.array([self.cond_prob_cp, 1 - self.cond_prob_cp]),
+                                  coh_vd_dir[is_long], np.array([num_cp, num_long - num_cp]))
+
+        counts = coh_vd_dir.copy()
+        counts[is_long] = cp_split[:, 1]
+        cp_flags = np.concatenate([np.zeros(len(comb_codes), dtype=bool), np.ones(is_long.sum(), dtype=bool)])
+        return np.concatenate([comb_codes, comb_codes[is_long]]), cp_flags, np.concatenate([counts, cp_split[:, 0]])
+
+    def get_quota_trials(self, n):
+        """
+        builds a block of n trials from the exact counts of self.quota_counts(), in random order
+        :param n: (int) number of trials
+        :return: pandas.DataFrame with the same columns as returned by self.get_n_trials()
+        """
+        return self.counts_to_trials(*self.quota_counts(n))
+
+    def counts_to_trials(self, comb_codes, cp_flags, counts):
+        """
+        builds a block of trials with the given number of trials per cell, in random order
+        :param comb_codes: (1D array) combination code of each cell
+        :param cp_flags: (1D boolean array) CP flag of each cell
+        :param counts: (1D array of int) number of trials of each cell
+        :return: pandas.DataFrame with the same columns as returned by self.get_n_trials()
+        """
+        order = self.rng.permutation(int(np.sum(counts)))
+        trial_df = self.codes_to_dataframe(np.repeat(comb_codes, counts)[order], np.repeat(cp_flags, counts)[order])
+        trial_df.coh = trial_df.coh.astype('category')
+        return trial_df
+
+    def cell_levels(self, comb_codes, cp_flags):
+        """
+        :param comb_codes: (1D array) combination codes
+        :param cp_flags: (1D boolean array) CP flags
+        :return: (2D numpy.ndarray of int) level index of each cell (rows) for each of TENSOR_AXES (columns)
+        """
+        cells = self._comb_cells[comb_codes] + self._cp_cell_shift * np.asarray(cp_flags, dtype=int)
+        return np.stack(np.unravel_index(cells, TENSOR_SHAPE), axis=1)
+
+    def marginal_probs(self):
+        """
+        :return: list with the theoretical probabilities of each of TENSOR_AXES, in the order of MARGINALS_TEMPLATE
+        """
+        return [np.array([self.theoretical_marginals[v][k] for k in MARGINALS_TEMPLATE[v]]) for v in TENSOR_AXES]
+
+    def stream_trials(self, n=None, slack=1):
+        """
+        yields trials one at a time, so that the running count of every level of every independent variable stays
+        close to its expected count at every prefix of the block. At step t, the candidate cells (a cell being a
+        coh x vd x dir x cp combination) are the cells whose levels would not exceed their expected count t * p by
+        more than slack trials. When a level lags behind its expected count by a whole trial or more, only the cells
+        with this level are kept. A candidate is drawn with probability proportional to its own deficit
+        t * p_cell - count_cell, or to p_cell if no candidate lags, so that the pooled frequencies of the cells, and not
+        only of the levels, follow their joint distribution. If the restrictions leave no cell, the cell whose levels
+        lag the most is picked. The state of the generator is the count of each cell and of each level, so that each
+        step takes constant time and memory
+        :param n: (int or None) number of trials to yield. If None, trials are yielded for as long as requested
+        :param slack: (float) largest excess, in trials, of a running count over its expected count
+        :return: generator of (coh, vd, dir, cp) tuples
+        """
+        levels = [list(MARGINALS_TEMPLATE[v].keys()) for v in TENSOR_AXES]
+        probs = self.marginal_probs()
+
+        # joint probability of each cell of a count tensor, in the order of np.ndindex(TENSOR_SHAPE)
+        cells = np.array(list(np.ndindex(TENSOR_SHAPE)))
+        is_long = np.array(levels[1])[cells[:, 1]] > CP_TIME
+        is_cp = np.array(levels[3])[cells[:, 3]].astype(bool)
+        cell_probs = probs[0][cells[:, 0]] * probs[1][cells[:, 1]] * probs[2][cells[:, 2]] * \
+            np.where(is_long, np.where(is_cp, self.cond_prob_cp, 1 - self.cond_prob_cp), ~is_cp)
+        possible = cell_probs > 0
+
+        counts = [np.zeros(len(p)) for p in probs]
+        cell_counts = np.zeros(len(cells))
+        for t in itertools.count(1) if n is None else range(1, n + 1):
+            deficits = [t * p - c for p, c in zip(probs, counts)]
+            cell_deficits = np.stack([d[cells[:, pos]] for pos, d in enumerate(deficits)], axis=1)
+
+            allowed = possible & np.all(cell_deficits >= 1 - slack, axis=1)
+            forced = allowed.copy()
+            for pos, d in enumerate(deficits):
+                if d.max() >= 1:
+                    forced &= cells[:, pos] == np.argmax(d)
+            candidates = forced if forced.any() else allowed
+
+            if candidates.any():
+                weights = np.where(candidates, np.maximum(t * cell_probs - cell_counts, 0), 0)
+                if not weights.any():
+                    weights = np.where(candidates, cell_probs, 0)
+                cdf = np.cumsum(weights)
+                cell = min(np.searchsorted(cdf, self.rng.random() * cdf[-1], side='right'), len(cells) - 1)
+            else:
+                cell = np.argmax(np.where(possible, cell_deficits.sum(axis=1), -np.inf))
+
+            cell_counts[cell] += 1
+            for pos in range(len(TENSOR_AXES)):
+                counts[pos][cells[cell, pos]] += 1
+            yield tuple(levels[pos][i] for pos, i in enumerate(cells[cell]))
 
-            # this is a CP trial only if VD > 200 and biased coin flip turns out HEADS
-            is_cp = comb[1] > CP_TIME and np.random.random() < self.cond_prob_cp
+    def checkpoint_checks(self, df, checkpoints):
+        """
+        applies the conditions of self.check_conditions() to prefixes of a block
+        :param df: dataframe of trials
+        :param checkpoints: (list of int) prefix lengths, i.e. numbers of trials counted from the start of the block
+        :return: (numpy.ndarray of bool) True for the prefixes which meet the conditions, in the order of checkpoints
+        """
+        codes = cell_codes(df)
+        tensors = np.stack([codes_to_tensor(codes[:c]) for c in checkpoints])
+        return self.check_tensors(tensors)
 
-            rows.append({'coh': comb[0], 'vd': comb[1], 'dir': comb[2], 'cp': is_cp})
+    def candidate_checkpoint_checks(self, comb_codes, cp_flags):
+        """
+        batched version of self.checkpoint_checks() at self.checkpoints, over integer-coded candidate blocks
+        :param comb_codes: (K x n) array of combination codes, as returned by self.draw_candidates()
+        :param cp_flags: (K x n) boolean array, as returned by self.draw_candidates()
+        :return: (K,) boolean array, True for candidates which meet the conditions at every checkpoint, or all True
+                 if self.checkpoints is None
+        """
+        passed = np.ones(len(comb_codes), dtype=bool)
+        if not passed.size:
+            return passed
+        for c in self.checkpoints or []:
+            passed &= self.check_tensors(self.candidate_tensors(comb_codes[:, :c], cp_flags[:, :c]))
+        return passed
 
-        trials_dataframe = pd.DataFrame(rows)
-        return trials_dataframe
+    def get_n_trials(self, n):
+        comb_codes, cp_flags = self.draw_candidates(1, n)
+        return self.codes_to_dataframe(comb_codes[0], cp_flags[0])
 
     def check_conditions(self, df, append_marginals=True):
         """
         we want at least five trials per Coh-VD pairs
         we don't want the empirical marginals to deviate from the theoretical ones by more than 5%
         """
-        num_cohvd_pairs = np.sum(df.duplicated(subset=['coh', 'vd'], keep=False))
-        if num_cohvd_pairs < 5:
+        tensor = count_tensor(df)
+        if not self.check_tensors(tensor[None])[0]:
             return False
 
-        emp_marginals = get_marginals(df)
-
-        for indep_var in emp_marginals.keys():
-            for key in emp_marginals[indep_var].keys():
-                error = abs(emp_marginals[indep_var][key] - self.theoretical_marginals[indep_var][key])
-                if error > self.marginal_tolerance:
-                    return False
-
         if append_marginals:
-            self.empirical_marginals = emp_marginals
+            self.empirical_marginals = marginals_from_tensor(tensor)
 
         return True
 
-    def save_to_csv(self, filename, with_meta_data=True):
+    def save_to_csv(self, filename, with_meta_data=True, with_timings=True):
+        """
+        writes the trials and their metadata to file. Despite the name of the method, the data file may also be a
+        compact npy file, see DATA_FORMATS. Csv files remain the ones read by the MATLAB task.
+        Each file is replaced atomically, the data file first and the metadata file last. In between, a reader may
+        see the new data with the old metadata, which fails the MD5 check instead of going unnoticed
+        :param filename: (str) path to data file, its extension sets the format
+        :param with_meta_data: (bool) whether to write the metadata file as well
+        :param with_timings: (bool) whether the TELEMETRY_TIMES of the generation are written to the metadata file.
+                             Without them, the same block always gets the same metadata bytes, as needed by
+                             trial_cache.TrialCache
+        :return: None
+        """
         if self.trial_data is None:
             print('No data to write')
         else:
-            check_extension(filename, 'csv')
+            fmt = data_format(filename)
 
-            self.trial_data.to_csv(filename, index=False)
+            # the metadata is built before any file is written, so that a failure cannot leave a data file without it
+            meta_filename = standard_meta_filename(filename)
+            telemetry = self.generation_telemetry
+            if telemetry is not None and not with_timings:
+                telemetry = {k: v for k, v in telemetry.items() if k not in TELEMETRY_TIMES}
+            meta_dict = {
+                'seed': self.seed,
+                'spawn_key': list(self.spawn_key),
+                'num_trials': self.num_trials,
+                'prob_cp': self.prob_cp,
+                'cond_prob_cp': self.cond_prob_cp,
+                'theoretical_marginals': self.theoretical_marginals,
+                'empirical_marginals': self.empirical_marginals,
+                'marginal_tolerance': self.marginal_tolerance,
+                'method': self.method,
+                'checkpoints': self.checkpoints,
+                'attempt_number': self.attempt_number,
+                'generation_telemetry': telemetry,
+                'data_format': fmt,
+                # csv_filename and csv_md5 refer to the data file, whatever its format
+                'csv_filename': filename
+            }
+            if fmt == 'npy':
+                meta_dict['label_codes'] = {k: list(MARGINALS_TEMPLATE[k].keys()) for k in TENSOR_AXES}
+
+            # serialize once, then hash and write the same bytes
+            if fmt == 'npy':
+                buffer = io.BytesIO()
+                np.save(buffer, self.get_trial_codes(), allow_pickle=False)
+                data_bytes = buffer.getvalue()
+            else:
+                data_bytes = self.trial_data.to_csv(index=False).encode()
+            meta_dict['csv_md5'] = hashlib.md5(data_bytes).hexdigest()
+            meta_bytes = json.dumps(meta_dict, indent=4).encode()
+
+            write_atomically(filename, data_bytes)
             print(f"file {filename} created")
 
             if with_meta_data:
-                meta_filename = standard_meta_filename(filename)
-                meta_dict = {
-                    'seed': self.seed,
-                    'num_trials': self.num_trials,
-                    'prob_cp': self.prob_cp,
-                    'cond_prob_cp': self.cond_prob_cp,
-                    'theoretical_marginals': self.theoretical_marginals,
-                    'empirical_marginals': self.empirical_marginals,
-                    'marginal_tolerance': self.marginal_tolerance,
-                    'csv_filename': filename,
-                    'csv_md5': md5(filename)
-                }
-                with open(meta_filename, 'w') as fp:
-                    json.dump(meta_dict, fp, indent=4)
-            print(f"medatadata file {meta_filename} created")
+                write_atomically(meta_filename, meta_bytes)
+                print(f"medatadata file {meta_filename} created")
+
+    def get_count_tensor(self):
+        """
+        count tensor of the trials attached to the object, see count_tensor()
+        :return: (numpy.ndarray of int) tensor with shape TENSOR_SHAPE
+        """
+        return count_tensor(self.trial_data)
 
     def count_conditions(self, ind_vars):
-        # todo: to count number of trials for a given combination of independent variables values
-        pass
+        """
+        counts the number of trials for each combination of values of the given independent variables
+        :param ind_vars: (list) subset of TENSOR_AXES, e.g. ['coh', 'cp', 'vd']
+        :return: pandas.DataFrame with one column per independent variable plus a 'count' column
+        """
+        return tensor_to_counts(self.get_count_tensor(), ind_vars)
 
 
 if __name__ == '__main__':
@@ -403,83 +1469,35 @@ if __name__ == '__main__':
     # number of blocks to enforce for each prob_cp value (other than 0)
     # ensure the latter divides the former
     assert np.mod(num_dual_report_blocks, len(all_vals)) == 0
-    num_blocks_single_prob_cp = num_dual_report_blocks / len(all_vals)
-
-    def gen_rand_prob_cp_seq(cp_vals, tot_num_blocks):
-        """
-        Generates a random sequence of prob_cp values to assign to each block.
-        In effect, samples a path from a len(cp_vals)-state Discrete Time Markov Chain
-        where the prob of transitioning from one state to itself is 0 for all states,
-        and the probability of transitioning from one state to any other state is uniform.
-        :param cp_vals: list of possible prob_cp values
-        :param tot_num_blocks: total number of blocks
-        :return: list of prob_cp values
-        """
-        # build random ordering of prob_cp across blocks
-        last_idx = np.random.randint(3)  # draws a number at random in the set {0, 1, 2}
-
-        num_vals = len(cp_vals)
-        val_idxs = {i for i in range(num_vals)}
-
-        prob_list = [cp_vals[last_idx]]
-
-        for r in range(tot_num_blocks - 1):
-            new_idxs = list(val_idxs - {last_idx})    # update allowed indices for this block (enforce a transition)
-            last_idx = new_idxs[np.random.randint(num_vals - 1)]  # pick one of the other two indices at random
-            prob_list.append(all_vals[last_idx])
-
-        return prob_list
-
-    def validate_prob_cp_seq(seq, num_blocks, num_blocks_seq, cp_vals):
-        assert len(seq) == num_blocks
-        for prob_cp in cp_vals:
-            cc = 0  # counter
-            for s in seq:
-                if s == prob_cp:
-                    cc += 1
-            if cc != num_blocks_seq:
-                return False
-        return True
-
-    prob_cp_list = [0 for _ in range(num_dual_report_blocks)]
-    maxout = 1000  # total number of iterations allowed for the following while loop
-    counter = 0
-    while not validate_prob_cp_seq(prob_cp_list, num_dual_report_blocks, num_blocks_single_prob_cp, all_vals):
-        prob_cp_list = gen_rand_prob_cp_seq(all_vals, num_dual_report_blocks)
-        counter += 1
-        # print('all_vals', all_vals)
-        # print('num_dual_report_blocks', num_dual_report_blocks)
-        # print('prob_cp_list', prob_cp_list)
-        # print('counter in while loop', counter)
-        if counter == maxout:
-            print(f"after {counter} attempts, not proper prob_cp list was reached")
-            break
-    else:
-        print(f'prob cp list for dual-report blocks found after {counter} attempts')
-        print(prob_cp_list)
-
-        dual_report_start_index = 3
-        block_length = 250  # number of trials to use for each block
-
-        filenames = ['Tut1.csv', 'Tut2.csv', 'Block2.csv', 'Tut3.csv']
-        for idx in range(num_dual_report_blocks):
-            filenames.append('Block' + str(idx + dual_report_start_index) + '.csv')
-
-        count = 0
-        dual_report_block_count = 0
-
-        for file in filenames:
-            count += 1
-
-            # todo: deal with tutorials
-            if file[:3] == 'Tut':
-                pass
-            # deal with blocks
-            if file == 'Block2.csv':  # Block2 is the standard dots task
-                t = Trials(prob_cp=0, num_trials=block_length, seed=count, marginal_tolerance=marg_tol)
-                t.save_to_csv(file)
-            elif file[:5] == 'Block':  # the other ones are dual-report blocks
-                t = Trials(prob_cp=prob_cp_list[dual_report_block_count], num_trials=block_length, seed=count,
-                           marginal_tolerance=marg_tol)
-                t.save_to_csv(file)
-                dual_report_block_count += 1
+    num_blocks_single_prob_cp = num_dual_report_blocks // len(all_vals)
+
+    # random ordering of prob_cp across blocks, without two consecutive blocks sharing the same prob_cp
+    rng = np.random.default_rng(np.random.SeedSequence(1))
+    prob_cp_list = sample_prob_cp_seq({v: num_blocks_single_prob_cp for v in all_vals}, rng)
+    print(prob_cp_list)
+
+    dual_report_start_index = 3
+    block_length = 250  # number of trials to use for each block
+
+    filenames = ['Tut1.csv', 'Tut2.csv', 'Block2.csv', 'Tut3.csv']
+    for idx in range(num_dual_report_blocks):
+        filenames.append('Block' + str(idx + dual_report_start_index) + '.csv')
+
+    count = 0
+    dual_report_block_count = 0
+
+    for file in filenames:
+        count += 1
+
+        # todo: deal with tutorials
+        if file[:3] == 'Tut':
+            pass
+        # deal with blocks
+        if file == 'Block2.csv':  # Block2 is the standard dots task
+            t = Trials(prob_cp=0, num_trials=block_length, seed=count, marginal_tolerance=marg_tol)
+            t.save_to_csv(file)
+        elif file[:5] == 'Block':  # the other ones are dual-report blocks
+            t = Trials(prob_cp=prob_cp_list[dual_report_block_count], num_trials=block_length, seed=count,
+                       marginal_tolerance=marg_tol)
+            t.save_to_csv(file)
+            dual_report_block_count += 1